@@ -0,0 +1,231 @@
+"""
+Nexus benchmarks
+
+Measure the Nexus listing and requirements dump paths against an in-process
+fake Nexus, serving '/service/rest/v1/components' pages with a configurable
+page size and latency. Each benchmark reports the wall time, the number of
+requests and the peak memory (from tracemalloc, in a second run, since it
+slows the code down).
+
+They only run with 'pytest --benchmark', see 'make bench'.
+"""
+
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import pytest
+
+import cli_builder
+import cli_nexus
+import common
+import nexus_index
+
+# (components, page size, latency in seconds). Nexus pages have 10 items
+_CASES = {
+    "1k": (1_000, 10, 0),
+    "10k": (10_000, 10, 0),
+    "10k-latency": (10_000, 10, 0.002),
+    "200k": (200_000, 100, 0),
+}
+
+
+def _component(repo_name: str, i: int) -> dict:
+    """Component with the same shape and a similar size as the Nexus ones"""
+    name = f"package-{i}"
+    version = f"1.{i % 100}.0"
+    return {
+        "id": f"component-{i:08}",
+        "repository": repo_name,
+        "format": "pypi",
+        "group": None,
+        "name": name,
+        "version": version,
+        "assets": [
+            {
+                "id": f"asset-{i:08}",
+                "path": f"packages/{name}/{version}/{name}-{version}.tar.gz",
+                "downloadUrl": f"http://localhost:8081/repository/{repo_name}/packages/{name}/{version}/{name}-{version}.tar.gz",
+                "repository": repo_name,
+                "format": "pypi",
+                "checksum": {"sha1": "0" * 40, "sha256": "0" * 64},
+                "contentType": "application/x-gzip",
+                "lastModified": "2023-11-20T10:00:00.000+00:00",
+                "lastDownloaded": "2023-11-21T10:00:00.000+00:00",
+                "uploader": "anonymous",
+                "fileSize": 12345,
+                "blobCreated": "2023-11-20T10:00:00.000+00:00",
+            }
+        ],
+    }
+
+
+class _FakeNexus(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, count: int, page_size: int, latency: float):
+        super().__init__(("127.0.0.1", 0), _FakeNexusHandler)
+        self.count = count
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = 0
+        self.url = f"http://127.0.0.1:{self.server_port}"
+
+
+class _FakeNexusHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, don't wait for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        nexus = self.server
+        nexus.requests += 1
+        time.sleep(nexus.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path.startswith("/service/rest/v1/repositories/"):
+            name = url.path.split("/")[5]
+            return self._send_json({"name": name, "format": "pypi", "type": "proxy"})
+
+        if url.path == "/service/rest/v1/components":
+            repo_name = query["repository"][0]
+            start = int(query.get("continuationToken", ["0"])[0])
+            end = min(start + nexus.page_size, nexus.count)
+            return self._send_json(
+                {
+                    "items": [_component(repo_name, i) for i in range(start, end)],
+                    "continuationToken": str(end) if end < nexus.count else None,
+                }
+            )
+
+        self.send_error(404)
+
+
+@contextlib.contextmanager
+def fake_nexus(count: int, page_size: int = 10, latency: float = 0):
+    """Run a fake Nexus in a background thread
+
+    Yields:
+        _FakeNexus: The server. 'url' is its address and 'requests' the
+                    number of requests served
+    """
+    nexus = _FakeNexus(count, page_size, latency)
+    thread = threading.Thread(target=nexus.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield nexus
+    finally:
+        nexus.shutdown()
+        nexus.server_close()
+
+
+@pytest.mark.benchmark
+class TestNexusBenchmark:
+    @pytest.fixture(params=list(_CASES))
+    def nexus(self, request, monkeypatch, tmp_path):
+        count, page_size, latency = _CASES[request.param]
+        with fake_nexus(count, page_size, latency) as nexus:
+            services = {"nexus": {"url_local": nexus.url}}
+            monkeypatch.setattr(common, "get_services", lambda path: services)
+            monkeypatch.setattr(
+                nexus_index,
+                "get_index",
+                lambda: nexus_index.NexusIndex(str(tmp_path / "index.sqlite3")),
+            )
+            nexus.case = request.param
+            nexus.services = services
+            yield nexus
+
+    @staticmethod
+    def _measure(nexus, benchmark_report, name: str, function) -> None:
+        """Run the function twice: timed, then with tracemalloc"""
+        nexus.requests = 0
+        started_at = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started_at
+        requests = nexus.requests
+
+        tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        benchmark_report(
+            {
+                "name": f"{name}[{nexus.case}]",
+                "components": nexus.count,
+                "seconds": elapsed,
+                "requests": requests,
+                "peak_memory": peak,
+            }
+        )
+
+    def test_repo_data(self, nexus, benchmark_report):
+        def _run():
+            repo_data = common._nexus_get_repo_data(nexus.services, "pip")
+            assert sum(1 for _ in repo_data["dependencies"]) == nexus.count
+
+        self._measure(nexus, benchmark_report, "repo_data", _run)
+
+    @pytest.mark.parametrize("as_json", [False, True], ids=["text", "json"])
+    def test_list_components(self, nexus, benchmark_report, as_json):
+        def _run():
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                cli_nexus.cmd_nexus_list_components.callback(
+                    clone_path="", repo_name="pip", json=as_json
+                )
+
+        self._measure(
+            nexus,
+            benchmark_report,
+            "list_components_" + ("json" if as_json else "text"),
+            _run,
+        )
+
+    def test_dump_requirements(self, nexus, benchmark_report, tmp_path):
+        requirements_out = str(tmp_path / "requirements.txt")
+
+        def _run():
+            # A new index each time, so this is a full sync
+            index_path = tmp_path / "index.sqlite3"
+            if index_path.exists():
+                index_path.unlink()
+            cli_builder.dump_dependencies_from_cachito_pip_proxy_to_file(
+                "", requirements_out, "pip"
+            )
+
+        self._measure(nexus, benchmark_report, "dump_requirements", _run)
+        with open(requirements_out) as f:
+            assert sum(1 for _ in f) == nexus.count
+
+    def test_dump_requirements_incremental(self, nexus, benchmark_report, tmp_path):
+        requirements_out = str(tmp_path / "requirements.txt")
+        index = nexus_index.NexusIndex(str(tmp_path / "incremental.sqlite3"))
+        index.sync(nexus.services, "pip")
+
+        def _run():
+            cli_builder._create_python_requirements_file(
+                requirements_out,
+                index.iter_components(nexus.services, "pip", full=False),
+            )
+
+        self._measure(nexus, benchmark_report, "dump_requirements_incremental", _run)
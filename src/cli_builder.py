@@ -1,19 +1,146 @@
 import os
 
 import click
-import jinja2
 
 import common
+import nexus_index
+import tracing
 
 _global = common.get_global()
 logger = common.get_logger()
 
 _cachito_repo_path = common.get_cachito_repository_path()
 
+# Number of per-build pypi proxy repositories kept in Nexus
+_KEEP_BUILD_PIP_REPOS = 5
 
-def _new_template_interceptor(container_file_path: str, services: dict) -> str:
+# Number of containers built at the same time
+_DEFAULT_BUILD_JOBS = 4
+
+# Poetry toolchain used to resolve the Python dependencies. Changing it
+# invalidates the cached resolutions
+_POETRY_VERSION = "1.7.1"
+_POETRY_PLUGIN_EXPORT_VERSION = "1.6.0"
+_PYTHON_RESOLVER_VERSION = (
+    f"poetry=={_POETRY_VERSION},poetry-plugin-export=={_POETRY_PLUGIN_EXPORT_VERSION}"
+)
+
+
+# Templates
+# ====================
+common.register_template(
+    "cachito.containerfile",
+    """
+{{ container_file_content_before_disable }}
+#<cachito-disable> BEGIN
+RUN set -x \\
+    && echo "nameserver 1.1.1.1" > /etc/resolv.conf \\
+    && echo "nameserver 8.8.8.8" > /etc/resolv.conf
+#<cachito-disable> END
+{{ container_file_content_after_disable }}
+#<cachito-proxy> BEGIN
+RUN set -x \\
+    && rm -f /etc/resolv.conf
+ENV PIP_NO_BINARY=:all:
+{% for k, v in custom_envs.items() %}
+ENV {{ k }}={{ v }}
+{%- endfor %}
+#<cachito-proxy> END
+{{ container_file_content_after_proxy }}
+""",
+    autoescape=True,
+)
+
+common.register_template(
+    "pyproject.toml",
+    """[tool.poetry]
+name = "test"
+version = "0.0.1"
+description = "test"
+authors = ["test"]
+
+[tool.poetry.dependencies]
+python = "{{ pythonVersion }}"
+{% for dependency in dependencies -%}
+{{ dependency }}
+{% endfor %}
+
+[build-system]
+requires = ["poetry-core"]
+build-backend = "poetry.core.masonry.api"
+""",
+)
+
+common.register_template(
+    "extract-dependencies.sh",
+    """#!/bin/sh
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
+set -ex
+
+export PYTHON_KEYRING_BACKEND=keyring.backends.null.Keyring
+
+POETRY="{{ poetry }}"
+
+cd "$SCRIPT_DIR"
+
+rm -f ./requirements-freeze.txt
+
+cat pyproject.toml
+# Keep the versions of an existing lock file
+"$POETRY" check --lock || "$POETRY" lock --no-update
+"$POETRY" export --without-hashes --all-extras --format=requirements.txt > ./requirements-freeze.txt
+
+# The images build the packages from source: check every pinned version
+# has an sdist
+SDIST_DIR="$(mktemp -d)"
+trap 'rm -rf "$SDIST_DIR"' EXIT
+export PIP_NO_BINARY=:all:
+"$(dirname "$POETRY")/pip" download --no-deps --disable-pip-version-check -r ./requirements-freeze.txt -d "$SDIST_DIR"
+""",
+)
+
+common.register_template(
+    "proxy.sh",
+    """#!/bin/sh
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
+
+# Get current -e and -x states
+_e=$(set +o | grep -q 'errexit'; echo $?)
+_x=$(set +o | grep -q 'xtrace'; echo $?)
+
+set -ex
+
+{% if container.proxies.python %}
+#<cachito-proxy> BEGIN
+export PIP_NO_BINARY=:all:
+# Special vars
+{%- for k, v in custom_envs.items() %}
+export {{ k }}={{ v }}
+{%- endfor %}
+#<cachito-proxy> END
+{% endif %}
+
+# Restore -e and -x states
+if [ $_e -eq 0 ]; then
+    set -e
+fi
+if [ $_x -eq 0 ]; then
+    set -x
+fi
+""",
+)
+
+
+def _new_template_interceptor(
+    container_file_path: str, services: dict, pip_repo_name: str
+) -> str:
     """Intercept the Containerfile and create a new one with the Cachito instructions.
 
+    Args:
+        container_file_path (str): Path to the original Containerfile
+        services (dict): Services data, from common.get_services()
+        pip_repo_name (str): Nexus pypi proxy repository used by the build
+
     Returns:
         str: The path to the new Containerfile
     """
@@ -72,45 +199,76 @@ def _new_template_interceptor(container_file_path: str, services: dict) -> str:
             template_data["custom_envs"].update(service["custom_envs"])
 
     # Generate the new Containerfile
-    template_string = """
-{{ container_file_content_before_disable }}
-#<cachito-disable> BEGIN
-RUN set -x \\
-    && echo "nameserver 1.1.1.1" > /etc/resolv.conf \\
-    && echo "nameserver 8.8.8.8" > /etc/resolv.conf
-#<cachito-disable> END
-{{ container_file_content_after_disable }}
-#<cachito-proxy> BEGIN
-RUN set -x \\
-    && rm -f /etc/resolv.conf
-ENV PIP_NO_BINARY=:all:
-{% for k, v in custom_envs.items() %}
-ENV {{ k }}={{ v }}
-{%- endfor %}
-#<cachito-proxy> END
-{{ container_file_content_after_proxy }}
-"""
-    template_env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("."), autoescape=True
-    )
-    template = template_env.from_string(template_string)
-    template_result = template.render(template_data)
+    template_result = common.render_template("cachito.containerfile", template_data)
 
     # Add new proxies to template_result
-    # TODO create new proxies instead of using the "cachito-pip-proxy"
-    template_result = template_result.replace("<PIP_REPO_NAME>", "cachito-pip-proxy")
+    template_result = template_result.replace("<PIP_REPO_NAME>", pip_repo_name)
 
     # Write the new Containerfile
     new_containerfile_path = os.path.abspath(
         os.path.join(os.path.dirname(container_file_path), "cachito.containerfile")
     )
-    logger.info("Writing new Containerfile to: " + new_containerfile_path)
-    with open(new_containerfile_path, "w") as f:
-        f.write(template_result)
+    if common.write_file_if_changed(new_containerfile_path, template_result):
+        logger.info("Writing new Containerfile to: " + new_containerfile_path)
 
     return new_containerfile_path
 
 
+def _parse_containerfile(content: str) -> tuple:
+    """Find the images and the build context paths used by a Containerfile
+
+    Args:
+        content (str): Containerfile content
+
+    Returns:
+        tuple: (images, context_paths). The images from the 'FROM' and
+               'COPY --from' instructions, excluding the build stages. The
+               sources of the 'ADD' and 'COPY' instructions that read from
+               the build context
+    """
+    import json
+    import re
+
+    images = []
+    stages = set()
+    context_paths = []
+    # Join the continuation lines
+    content = re.sub(r"\\[ \t]*\r?\n", " ", content)
+    for line in content.splitlines():
+        instruction, _, args = line.strip().partition(" ")
+        instruction = instruction.upper()
+        if instruction not in ("FROM", "ADD", "COPY"):
+            continue
+        args = args.strip()
+        flags = []
+        while args.startswith("--"):
+            flag, _, args = args.partition(" ")
+            flags.append(flag)
+            args = args.strip()
+        if instruction == "FROM":
+            tokens = args.split()
+            if tokens and tokens[0] not in stages:
+                images.append(tokens[0])
+            if len(tokens) >= 3 and tokens[1].upper() == "AS":
+                stages.add(tokens[2])
+            continue
+        from_flags = [flag for flag in flags if flag.lower().startswith("--from=")]
+        if from_flags:
+            image = from_flags[0].split("=", 1)[1]
+            if image not in stages and not image.isdigit():
+                images.append(image)
+            continue
+        if args.startswith("["):
+            try:
+                tokens = json.loads(args)
+            except ValueError:
+                tokens = args.split()
+        else:
+            tokens = args.split()
+        context_paths.extend(tokens[:-1])
+    return images, context_paths
+
+
 def _build_validate(file, build_context):
     """Validate the build parameters"""
 
@@ -128,25 +286,31 @@ def _build_validate(file, build_context):
         build_context = os.path.dirname(os.path.abspath(file))
 
 
-def _create_python_requirements_file(file_abs: str, repo_data: dict) -> None:
+def _create_python_requirements_file(file_abs: str, dependencies) -> None:
+    """Create a requirements.txt file from the components of a Nexus repository
+
+    Args:
+        file_abs (str): Output file path. If it is a directory, the
+                        'requirements.txt' is created next to it
+        dependencies (iterable): Nexus components, as yielded by
+                                 nexus_index.NexusIndex.iter_components()
+    """
+
     def _generate_python_requirements_file(
-        repo_data: dict,
+        dependencies,
         python_requirements_file_path: str,
     ) -> None:
         """Generate a requirements.txt file for a Python project"""
-        dependencies_list = []
-        for dependency in repo_data["dependencies"]:
-            if dependency["format"] == "pypi":
-                dependencies_list.append(
-                    f"{dependency['name']}=={dependency['version']}"
-                )
-        dependencies_list.sort()
+        dependencies_list = sorted(
+            {
+                f"{dependency['name']}=={dependency['version']}"
+                for dependency in dependencies
+                if dependency["format"] == "pypi"
+            }
+        )
 
-        out = ""
-        for dependency in dependencies_list:
-            out += f"{dependency}\n"
         with open(python_requirements_file_path, "w") as f:
-            f.write(out)
+            f.writelines(f"{dependency}\n" for dependency in dependencies_list)
 
     if os.path.isdir(file_abs):
         python_requirements_file_path = os.path.abspath(
@@ -155,24 +319,140 @@ def _create_python_requirements_file(file_abs: str, repo_data: dict) -> None:
     else:
         python_requirements_file_path = file_abs
     logger.info("Retrieving: " + python_requirements_file_path)
-    _generate_python_requirements_file(repo_data, python_requirements_file_path)
+    _generate_python_requirements_file(dependencies, python_requirements_file_path)
 
 
+@tracing.traced()
 def dump_dependencies_from_cachito_pip_proxy_to_file(
     cachito_repo_path: str,
     requirements_out: str,
+    pip_repo_name=common._NEXUS_PIP_PROXY_REPO,
 ):
-    """Dump the dependencies list from the Cachito pip proxy repo to a file"""
+    """Dump the dependencies list from the Cachito pip proxy repo to a file
+
+    Args:
+        cachito_repo_path (str): Path where the Cachito repository is located
+        requirements_out (str): Output file path
+        pip_repo_name (str|list): Nexus pypi proxy repository name, or a list
+                                  of names to merge
+    """
+    import itertools
+
     services = common.get_services(cachito_repo_path)
-    repo_data = common._nexus_get_repo_data(services, "cachito-pip-proxy")
-    _create_python_requirements_file(requirements_out, repo_data)
+    if isinstance(pip_repo_name, str):
+        pip_repo_name = [pip_repo_name]
+    index = nexus_index.get_index()
+    _create_python_requirements_file(
+        requirements_out,
+        itertools.chain.from_iterable(
+            index.iter_components(services, repo_name) for repo_name in pip_repo_name
+        ),
+    )
+
+
+@tracing.traced()
+def create_build_pip_repo(services: dict, keep: int, protect=()) -> str:
+    """Create a new pypi proxy repository for a build
+
+    The per-build repositories older than the 'keep' newest ones are deleted,
+    except the 'protect' ones.
+
+    Returns:
+        str: The new repository name
+    """
+    index = nexus_index.get_index()
+    for repo_name in common._nexus_delete_old_build_pip_repos(
+        services, keep - 1, protect
+    ):
+        index.forget(repo_name)
+    return common._nexus_create_build_pip_repo(services)
+
+
+def get_poetry_venv_path() -> str:
+    """Returns the path of the virtualenv with the Poetry toolchain"""
+    return os.path.join(common.get_cache_dir(), "poetry-venv")
+
+
+def ensure_poetry_venv() -> str:
+    """Create the virtualenv with the Poetry toolchain, if needed
+
+    The virtualenv is shared by all the workdirs and only rebuilt when the
+    toolchain versions change.
+
+    Returns:
+        str: Path of the poetry executable
+    """
+    import fcntl
+
+    venv_path = get_poetry_venv_path()
+    version_path = os.path.join(venv_path, "constructor-version.txt")
+    os.makedirs(os.path.dirname(venv_path), exist_ok=True)
+
+    # Other constructor processes may be creating the same virtualenv
+    with open(venv_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(version_path, "r") as f:
+                is_up_to_date = f.read() == _PYTHON_RESOLVER_VERSION
+        except OSError:
+            is_up_to_date = False
+        if not is_up_to_date:
+            logger.info("Creating Poetry virtualenv: " + venv_path)
+            common.run(["rm", "-rf", venv_path])
+            common.run(["python3", "-m", "venv", venv_path])
+            common.run(
+                [os.path.join(venv_path, "bin/pip"), "install", "-U", "pip"],
+                print_output=True,
+            )
+            common.run(
+                [
+                    os.path.join(venv_path, "bin/pip"),
+                    "install",
+                    f"poetry=={_POETRY_VERSION}",
+                    f"poetry-plugin-export=={_POETRY_PLUGIN_EXPORT_VERSION}",
+                ],
+                print_output=True,
+            )
+            with open(version_path, "w") as f:
+                f.write(_PYTHON_RESOLVER_VERSION)
+    return os.path.join(venv_path, "bin/poetry")
+
+
+def get_python_resolution_path(
+    dependencies: list,
+    python_version: str,
+    resolver_version: str = _PYTHON_RESOLVER_VERSION,
+) -> str:
+    """Returns the cached requirements-freeze.txt path of a resolution
+
+    Args:
+        dependencies (list): Dependencies. Example: ["cryptography==41.0.5"]
+        python_version (str): Python version constraint. Example: ^3.9
+        resolver_version (str): Version of the resolver toolchain
+    """
+    import hashlib
+    import json
+
+    key = hashlib.sha256(
+        json.dumps(
+            {
+                "dependencies": sorted(dependencies),
+                "pythonVersion": python_version,
+                "resolver": resolver_version,
+            },
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+    return os.path.join(
+        common.get_cache_dir(), "python-resolve", key, "requirements-freeze.txt"
+    )
 
 
 @click.command()
 @click.option(
     "--clone-path",
     "-p",
-    default=os.getcwd() + "/cache/cachito_repo",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
     help="Path where the Cachito repository is located",
 )
 @click.option(
@@ -213,7 +493,8 @@ def cmd_build(clone_path, file, build_context, tag, no_cache):
     else:
         build_context_abs = os.path.dirname(file_abs)
 
-    new_file_abs = _new_template_interceptor(file_abs, services)
+    pip_repo_name = create_build_pip_repo(services, keep=_KEEP_BUILD_PIP_REPOS)
+    new_file_abs = _new_template_interceptor(file_abs, services, pip_repo_name)
 
     try:
         command = (
@@ -233,9 +514,7 @@ def cmd_build(clone_path, file, build_context, tag, no_cache):
             ]
         )
         common.cmd_log(command)
-        rc = os.system(" ".join(command))
-        if rc != 0:
-            raise Exception(f"Return code: {rc}")
+        common.run(command, print_output=True)
 
     except Exception as e:
         logger.error("Error building image. Aborting")
@@ -244,17 +523,17 @@ def cmd_build(clone_path, file, build_context, tag, no_cache):
 
     logger.info("Image built successfully")
 
-    # TODO create new proxies instead of using the "cachito-pip-proxy"
-    repo_data = common._nexus_get_repo_data(services, "cachito-pip-proxy")
-
-    _create_python_requirements_file(file_abs, repo_data)
+    _create_python_requirements_file(
+        file_abs,
+        nexus_index.get_index().iter_components(services, pip_repo_name),
+    )
 
 
 @click.command()
 @click.option(
     "--clone-path",
     "-p",
-    default=os.getcwd() + "/cache/cachito_repo",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
     help="Path where the Cachito repository is located",
 )
 @click.option(
@@ -268,21 +547,33 @@ def cmd_build(clone_path, file, build_context, tag, no_cache):
     "-c",
     help="Path to the build context. Defaults to the directory of the Containerfile",
 )
-def cmd_get_dependencies(clone_path, file, build_context):
+@click.option(
+    "--pip-repo-name",
+    default=common._NEXUS_PIP_PROXY_REPO,
+    help="Nexus pypi proxy repository used by the build",
+)
+def cmd_get_dependencies(clone_path, file, build_context, pip_repo_name):
     """Get the dependencies files for a container build"""
     _build_validate(file, build_context)
 
     services = common.get_services(clone_path)
-    # TODO create new proxies instead of using the "cachito-pip-proxy"
-    repo_data = common._nexus_get_repo_data(services, "cachito-pip-proxy")
     file_abs = os.path.abspath(file)
 
-    _create_python_requirements_file(file_abs, repo_data)
+    _create_python_requirements_file(
+        file_abs,
+        nexus_index.get_index().iter_components(services, pip_repo_name),
+    )
 
 
 # cmd_pip_generate
-# Params: requirements_file_in, requirements_file_out
+# Params: clone_path, requirements_file_in, requirements_file_out
 @click.command()
+@click.option(
+    "--clone-path",
+    "-p",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
+    help="Path where the Cachito repository is located",
+)
 @click.option(
     "--requirements-file-in",
     "-i",
@@ -295,10 +586,13 @@ def cmd_get_dependencies(clone_path, file, build_context):
     default="./requirements-cachito.txt",
     help="Path to the requirements file to be generated",
 )
-def cmd_pip_generate(requirements_file_in, requirements_file_out):
+def cmd_pip_generate(clone_path, requirements_file_in, requirements_file_out):
     """Reads a requirements.txt file and generates a requirements-cachito.txt file
     with all the indirect dependencies of the requirements.txt file.
     """
+    import sys
+    import tempfile
+
     import cli_server
 
     # Check if server is running, start OR restart if needed
@@ -311,31 +605,65 @@ def cmd_pip_generate(requirements_file_in, requirements_file_out):
         logger.error("requirements_file_in not found: " + requirements_file_in_abs)
         exit(1)
 
-    # TODO create new proxies instead of using the "cachito-pip-proxy"
-    repo_data = common._nexus_get_repo_data({}, "cachito-pip-proxy")
-
-    dependencies_list = []
-    for dependency in repo_data["dependencies"]:
-        if dependency["format"] == "pypi":
-            dependencies_list.append(f"{dependency['name']}=={dependency['version']}")
-    dependencies_list.sort()
+    # Capture the dependencies in a new pip proxy repository
+    services = common.get_services(clone_path)
+    pip_repo_name = create_build_pip_repo(services, keep=_KEEP_BUILD_PIP_REPOS)
+    nexus_envs = services["nexus"]["custom_envs"]
+    index_url = (
+        nexus_envs["PIP_INDEX_URL"]
+        .replace("<PIP_REPO_NAME>", pip_repo_name)
+        .replace("host.containers.internal", "localhost")
+    )
+    with tempfile.TemporaryDirectory() as download_dir:
+        common.run(
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "download",
+                "--disable-pip-version-check",
+                "--index-url",
+                index_url,
+                "--trusted-host",
+                nexus_envs["PIP_TRUSTED_HOST"].replace(
+                    "host.containers.internal", "localhost"
+                ),
+                "-r",
+                requirements_file_in_abs,
+                "-d",
+                download_dir,
+            ],
+            print_output=True,
+        )
 
-    out = ""
-    for dependency in dependencies_list:
-        out += f"{dependency}\n"
-    with open(requirements_file_out_abs, "w") as f:
-        f.write(out)
+    _create_python_requirements_file(
+        requirements_file_out_abs,
+        nexus_index.get_index().iter_components(services, pip_repo_name),
+    )
 
 
 class Builder:
     config = None
 
-    def __init__(self, config_file_path: str):
+    def __init__(
+        self,
+        config_file_path: str,
+        keep_pip_repos: int = _KEEP_BUILD_PIP_REPOS,
+        force_rebuild: bool = False,
+    ):
+        import threading
+
         self._load_config(config_file_path)
+        self.keep_pip_repos = keep_pip_repos
+        self.force_rebuild = force_rebuild
+        self.pip_repo_name = None
 
         # Create the workdir
         os.makedirs(self.config.workdir.path, exist_ok=True)
 
+        self._build_manifest = self._read_build_manifest()
+        self._build_manifest_lock = threading.Lock()
+
     def _load_config(self, config_file_path: str):
         """Load the config file and validate it"""
         self.config_file_path = config_file_path
@@ -417,6 +745,11 @@ class Builder:
                             error="Invalid pythonVersion. Valid example: ^3.9",
                         ),
                         "includeDependencies": And(bool),
+                        Optional("resolver"): And(
+                            str,
+                            lambda s: s in ("poetry", "native"),
+                            error="Invalid resolver. Valid values: [poetry, native]",
+                        ),
                         "dependencies": [
                             And(
                                 str,
@@ -497,48 +830,179 @@ class Builder:
 
         return True
 
-    def _pull_sources(self):
-        """Pull the sources"""
+    def _sources_lock_path(self) -> str:
+        return os.path.join(self.config.workdir.path, "constructor/sources.lock")
+
+    def _read_sources_lock(self) -> dict:
+        import json
+
+        try:
+            with open(self._sources_lock_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_sources_lock(self, lock: dict) -> None:
+        import json
+
+        os.makedirs(os.path.dirname(self._sources_lock_path()), exist_ok=True)
+        with open(self._sources_lock_path(), "w") as f:
+            json.dump(lock, f, indent=4, sort_keys=True)
+
+    def _source_is_up_to_date(self, source: dict, locked: dict) -> bool:
+        """Check if a source checkout matches its lock entry
+
+        Tags and commits are immutable, so they only need a local check.
+        Branches need a single 'git ls-remote'.
+        """
+        if not locked or locked["url"] != source.url or locked["ref"] != source.ref:
+            return False
+        _source_path = os.path.join(
+            self.config.workdir.path,
+            "constructor/sources/",
+            source.path,
+        )
+        if common.git_head_commit(_source_path) != locked["commit"]:
+            return False
+        if locked["kind"] == "branch":
+            return (
+                common.git_ls_remote_branch(source.url, source.ref) == locked["commit"]
+            )
+        return True
+
+    @tracing.traced("pull_sources")
+    def _pull_sources(self, jobs: int = 1):
+        """Pull the sources
+
+        The sources are fetched concurrently into the shared git mirrors,
+        then checked out from them into the workdir. The commit of each
+        source is recorded in $WORKDIR/constructor/sources.lock, and the
+        sources already checked out at the locked commit are skipped.
+
+        Args:
+            jobs (int): Maximum number of concurrent fetches and checkouts
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
         for source in self.config.sources:
+            if source.kind != "git":
+                logger.error("Unsupported source kind: " + source.kind)
+                exit(1)
+
+        def _pull_source(source, mirror_path):
             _source_path = os.path.join(
                 self.config.workdir.path,
                 "constructor/sources/",
                 source.path,
             )
-            if source.kind == "git":
-                logger.info("Pulling source [git]: " + _source_path)
-                common.git_pull(
-                    source.url,
-                    source.ref,
-                    _source_path,
-                )
-            else:
-                logger.error("Unsupported source kind: " + source.kind)
-                exit(1)
+            logger.info("Pulling source [git]: " + _source_path)
+            return common.git_pull(
+                source.url,
+                source.ref,
+                _source_path,
+                mirror_path=mirror_path,
+            )
 
+        lock = self._read_sources_lock()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            up_to_date = list(
+                executor.map(
+                    lambda source: self._source_is_up_to_date(
+                        source, lock.get(source.path)
+                    ),
+                    self.config.sources,
+                )
+            )
+            sources = []
+            for source, is_up_to_date in zip(self.config.sources, up_to_date):
+                if is_up_to_date:
+                    logger.info(f"Source up to date [git]: {source.path}")
+                else:
+                    sources.append(source)
+            if not sources:
+                return
+
+            urls = list(dict.fromkeys(source.url for source in sources))
+            mirror_paths = dict(zip(urls, executor.map(common.git_mirror_update, urls)))
+            resolved_refs = executor.map(
+                lambda source: _pull_source(source, mirror_paths[source.url]),
+                sources,
+            )
+            for source, resolved_ref in zip(sources, resolved_refs):
+                lock[source.path] = {
+                    "url": source.url,
+                    "ref": source.ref,
+                    **resolved_ref,
+                }
+        self._write_sources_lock(lock)
+
+    @tracing.traced("setup_package_managers")
     def _setup_package_managers(self):
         def _create_python_dependencies_files(in_dependencies) -> list:
             """Get the list of Python dependencies
 
-            Use poetry to get the list of dependencies
+            Use poetry, or the native resolver, to get the list of
+            dependencies. The resolutions are cached by dependencies,
+            pythonVersion and resolver version.
             """
+            import shutil
+
+            import python_resolver
+
+            _is_native = self.config.packageManagers.python.resolver == "native"
+
             _python_base_path = os.path.join(
                 self.config.workdir.path,
                 "constructor/packagemanager/python",
             )
+            _requirements_freeze_path = os.path.join(
+                _python_base_path, "requirements-freeze.txt"
+            )
 
             if not self.config.packageManagers.python.includeDependencies:
                 # Write the dependencies to $WORKDIR/constructor/packagemanager/python/requirements-freeze.txt
                 # but create the directory first
                 os.makedirs(_python_base_path, exist_ok=True)
-                with open(
-                    os.path.join(_python_base_path, "requirements-freeze.txt"),
-                    "w",
-                ) as f:
+                with open(_requirements_freeze_path, "w") as f:
                     f.write("\n".join(in_dependencies))
 
                 return list(self.config.packageManagers.python.dependencies)
 
+            _resolution_path = get_python_resolution_path(
+                list(in_dependencies),
+                self.config.packageManagers.python.pythonVersion,
+                (
+                    python_resolver.RESOLVER_VERSION
+                    if _is_native
+                    else _PYTHON_RESOLVER_VERSION
+                ),
+            )
+            if os.path.isfile(_resolution_path):
+                logger.info("Using the cached Python resolution: " + _resolution_path)
+                os.makedirs(_python_base_path, exist_ok=True)
+                shutil.copyfile(_resolution_path, _requirements_freeze_path)
+                return
+
+            def _cache_resolution():
+                os.makedirs(os.path.dirname(_resolution_path), exist_ok=True)
+                shutil.copyfile(_requirements_freeze_path, _resolution_path + ".tmp")
+                os.replace(_resolution_path + ".tmp", _resolution_path)
+
+            if _is_native:
+                logger.info("Resolving the Python dependencies from the Nexus index")
+                pins = python_resolver.resolve(
+                    common.get_services(_cachito_repo_path),
+                    list(in_dependencies),
+                    self.config.packageManagers.python.pythonVersion,
+                )
+                os.makedirs(_python_base_path, exist_ok=True)
+                with open(_requirements_freeze_path, "w") as f:
+                    f.writelines(
+                        f"{name}=={version}\n" for name, version in sorted(pins.items())
+                    )
+                _cache_resolution()
+                return
+
             # Use poetry
             # Create the pyproject.toml file
             _pyproject_toml_path = os.path.join(
@@ -546,35 +1010,19 @@ class Builder:
                 "pyproject.toml",
             )
             logger.info("Creating pyproject.toml file: " + _pyproject_toml_path)
-            template_string = """[tool.poetry]
-name = "test"
-version = "0.0.1"
-description = "test"
-authors = ["test"]
-
-[tool.poetry.dependencies]
-python = "{{ pythonVersion }}"
-{% for dependency in dependencies -%}
-{{ dependency }}
-{% endfor %}
-
-[build-system]
-requires = ["poetry-core"]
-build-backend = "poetry.core.masonry.api"
-"""
             _parsed_dependencies = []
             for dependency in in_dependencies:
                 _parsed_dependencies.append(
                     f'{dependency.split("==")[0]} = "{dependency.split("==")[1]}"'
                 )
-            print(_parsed_dependencies)
+            logger.debug(f"Poetry dependencies: {_parsed_dependencies}")
             template_data = {
                 "pythonVersion": self.config.packageManagers.python.pythonVersion,
                 "dependencies": _parsed_dependencies,
             }
             common.create_file_from_template(
                 _pyproject_toml_path,
-                template_string,
+                "pyproject.toml",
                 template_data,
             )
 
@@ -587,36 +1035,18 @@ build-backend = "poetry.core.masonry.api"
                 "Creating extract-dependencies.sh file: "
                 + _extract_dependencies_sh_path
             )
-            template_string = """#!/bin/sh
-SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
-set -ex
-
-export PYTHON_KEYRING_BACKEND=keyring.backends.null.Keyring
-export PIP_NO_BINARY=:all:
-
-cd $SCRIPT_DIR
-
-rm -f ./requirements-freeze.txt
-rm -f ./poetry.lock
-
-python3 -m venv poetry-venv
-./poetry-venv/bin/pip install -U pip
-./poetry-venv/bin/pip install poetry
-./poetry-venv/bin/pip install poetry-plugin-export
-cat pyproject.toml
-./poetry-venv/bin/poetry install --no-root --all-extras --compile --no-cache
-./poetry-venv/bin/poetry export --without-hashes --all-extras --format=requirements.txt > ./requirements-freeze.txt
-"""
             common.create_file_from_template(
                 _extract_dependencies_sh_path,
-                template_string,
-                {},
+                "extract-dependencies.sh",
+                {"poetry": ensure_poetry_venv()},
             )
             common.run(["chmod", "+x", _extract_dependencies_sh_path])
 
             # Run extract-dependencies.sh
             logger.info("Running extract-dependencies.sh")
-            common.run([_extract_dependencies_sh_path])
+            common.run([_extract_dependencies_sh_path], print_output=True)
+
+            _cache_resolution()
 
         if "ansible" in self.config.packageManagers:
             # TODO
@@ -627,8 +1057,260 @@ cat pyproject.toml
                 self.config.packageManagers.python.dependencies
             )
 
-    def _build_image(self, container: dict):
-        """Build the container image"""
+    def _containerfile_content(self, container: dict) -> str:
+        """Returns the original Containerfile content of a container"""
+        if container.containerfilePath:
+            with open(
+                os.path.join(
+                    os.path.dirname(self.config_file_path),
+                    container.containerfilePath,
+                ),
+                "r",
+            ) as f:
+                return f.read()
+        return container.containerfileContent
+
+    def _container_dependencies(self) -> dict:
+        """Infer which containers each container is built from
+
+        A container depends on another one when its Containerfile
+        references the other container's imageName, in a 'FROM' or in a
+        'COPY --from'.
+
+        Returns:
+            dict: {container name: set of container names}
+        """
+
+        def _normalize_image_name(image: str) -> str:
+            image = image.removeprefix("localhost/")
+            if "@" not in image and ":" not in image.rsplit("/", 1)[-1]:
+                image += ":latest"
+            return image
+
+        image_names = {
+            _normalize_image_name(container.imageName): container.name
+            for container in self.config.containers
+        }
+        dependencies = {}
+        for container in self.config.containers:
+            references, _ = _parse_containerfile(self._containerfile_content(container))
+            dependencies[container.name] = {
+                image_names[_normalize_image_name(image)]
+                for image in references
+                if _normalize_image_name(image) in image_names
+            } - {container.name}
+
+        # Reject cycles
+        remaining = {name: set(deps) for name, deps in dependencies.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                logger.error("Circular dependency between containers:")
+                logger.error("└─ " + ", ".join(sorted(remaining)))
+                exit(1)
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return dependencies
+
+    @tracing.traced("build_images")
+    def _build_images(self, jobs: int) -> None:
+        """Build the container images, independent ones concurrently
+
+        A container is built once all the containers it depends on were
+        built. If a build fails, only the containers depending on it are
+        skipped.
+
+        Args:
+            jobs (int): Maximum number of concurrent builds
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        def _build_image(container, prefix):
+            with tracing.span(
+                f"build {container.name}", image=container.imageName
+            ) as attributes:
+                attributes["built"] = self._build_image(container, prefix)
+
+        dependencies = self._container_dependencies()
+        containers = {container.name: container for container in self.config.containers}
+        pending = list(containers)
+        built = set()
+        failed = set()
+        skipped = set()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if dependencies[name] & (failed | skipped):
+                        logger.error(
+                            f"Skipping '{name}': depends on "
+                            + ", ".join(sorted(dependencies[name] & (failed | skipped)))
+                        )
+                        pending.remove(name)
+                        skipped.add(name)
+                    elif dependencies[name] <= built:
+                        pending.remove(name)
+                        running[
+                            executor.submit(
+                                _build_image,
+                                containers[name],
+                                f"[{name}] " if jobs > 1 else None,
+                            )
+                        ] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        built.add(name)
+                    except (Exception, SystemExit) as e:
+                        logger.error(f"Error building '{name}': {e}")
+                        failed.add(name)
+
+        if failed or skipped:
+            logger.error("Some images were not built")
+            for name in containers:
+                if name in failed:
+                    logger.error(f"├─ {containers[name].imageName}: failed")
+                elif name in skipped:
+                    logger.error(f"├─ {containers[name].imageName}: skipped")
+            exit(1)
+
+    def _build_manifest_path(self) -> str:
+        """Build manifest of the workdir
+
+        It is kept in the cache directory, and not in the workdir, which is
+        the context of the builds.
+        """
+        import hashlib
+
+        workdir = os.path.abspath(self.config.workdir.path)
+        key = hashlib.sha256(workdir.encode("utf-8")).hexdigest()
+        return os.path.join(common.get_cache_dir(), "build-manifests", f"{key}.json")
+
+    def _read_build_manifest(self) -> dict:
+        import json
+
+        try:
+            with open(self._build_manifest_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record_build(self, name: str, entry: dict) -> None:
+        """Store the build of a container in the build manifest"""
+        import json
+
+        with self._build_manifest_lock:
+            self._build_manifest[name] = entry
+            path = self._build_manifest_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self._build_manifest, f, indent=4, sort_keys=True)
+            os.replace(f"{path}.tmp", path)
+
+    def _build_fingerprint(
+        self, container: dict, containerfile_path: str, build_args: list
+    ) -> str:
+        """Fingerprint the inputs of a container build
+
+        The inputs are the Containerfile, the podman build args, the parent
+        images IDs, the proxy.sh, the frozen requirements and the build
+        context files read by 'ADD' and 'COPY'. The context files are
+        fingerprinted by their size and modification time, except the
+        generated ones, which are rewritten on every build.
+
+        Returns:
+            str: sha256 hex digest
+        """
+        import glob
+        import hashlib
+
+        workdir = self.config.workdir.path
+        generated_dirs = ("constructor/proxy/", "constructor/packagemanager/")
+        fingerprint = hashlib.sha256()
+
+        def _update(*values):
+            for value in values:
+                fingerprint.update(str(value).encode("utf-8"))
+                fingerprint.update(b"\0")
+
+        def _update_file_content(path: str):
+            try:
+                with open(path, "r") as f:
+                    file_content = f.read()
+            except (OSError, UnicodeDecodeError):
+                file_content = None
+            # The per-build pip repository name changes on every build and
+            # doesn't change the image content
+            if file_content and self.pip_repo_name:
+                file_content = file_content.replace(
+                    self.pip_repo_name, "<PIP_REPO_NAME>"
+                )
+            _update(os.path.relpath(path, workdir), file_content)
+
+        def _update_file(path: str):
+            if os.path.relpath(path, workdir).startswith(generated_dirs):
+                _update_file_content(path)
+                return
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                _update(os.path.relpath(path, workdir), None)
+                return
+            _update(os.path.relpath(path, workdir), stat.st_size, stat.st_mtime_ns)
+
+        with open(containerfile_path, "r") as f:
+            content = f.read()
+        _update(content, container.imageName, *build_args)
+
+        images, context_paths = _parse_containerfile(content)
+        image_ids = common.podman_image_ids(images)
+        for image in images:
+            _update(image, image_ids[image])
+
+        _update_file_content(
+            os.path.join(workdir, "constructor/proxy", container.name, "proxy.sh")
+        )
+        _update_file_content(
+            os.path.join(
+                workdir, "constructor/packagemanager/python/requirements-freeze.txt"
+            )
+        )
+
+        for context_path in context_paths:
+            if "://" in context_path:
+                _update(context_path)
+                continue
+            matches = sorted(glob.glob(os.path.join(workdir, context_path.lstrip("/"))))
+            for match in matches or [os.path.join(workdir, context_path.lstrip("/"))]:
+                if not os.path.isdir(match) or os.path.islink(match):
+                    _update_file(match)
+                    continue
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    for name in sorted(files) + dirs:
+                        _update_file(os.path.join(root, name))
+        return fingerprint.hexdigest()
+
+    def _build_image(self, container: dict, prefix: str = None):
+        """Build the container image
+
+        The build is skipped when the fingerprint of its inputs matches the
+        last successful build and the image wasn't replaced since then.
+
+        Args:
+            container (dict): Container config
+            prefix (str): Prefix printed before each line of the build output
+
+        Returns:
+            bool: False if the build was skipped
+        """
         _containerfile_path = None
 
         if not common.is_running(_cachito_repo_path):
@@ -640,27 +1322,44 @@ cat pyproject.toml
             _containerfile_path = os.path.join(
                 self.config.workdir.path, container.containerfilePath
             )
-            logger.info("Copying Containerfile: " + _containerfile_path)
             _original_file_path = os.path.join(
                 os.path.dirname(self.config_file_path),
                 container.containerfilePath,
             )
-            common.run(["cp", _original_file_path, _containerfile_path])
+            with open(_original_file_path, "r") as f:
+                _containerfile_content = f.read()
         else:
             _containerfile_path = os.path.join(
-                self.config.workdir.path, "base_image.containerfile"
+                self.config.workdir.path, f"{container.name}.containerfile"
             )
+            _containerfile_content = container.containerfileContent
+
+        # Keep the modification time of an unchanged Containerfile, it can
+        # be part of the build context
+        if common.write_file_if_changed(_containerfile_path, _containerfile_content):
             logger.info("Creating Containerfile: " + _containerfile_path)
-            with open(_containerfile_path, "w") as f:
-                f.write(container.containerfileContent)
 
-        # Build the image
-        logger.info(f"Building image: {container.imageName}")
         _build_args = []
         if not container.podmanCacheEnabled:
             _build_args.append("--no-cache")
         if container.restrictions.disableDnsResolution:
             _build_args.append("--dns=none")
+
+        fingerprint = self._build_fingerprint(
+            container, _containerfile_path, _build_args
+        )
+        last_build = self._build_manifest.get(container.name, {})
+        if (
+            not self.force_rebuild
+            and last_build.get("fingerprint") == fingerprint
+            and last_build.get("image_id")
+            and common.podman_image_id(container.imageName) == last_build["image_id"]
+        ):
+            logger.info(f"Image up to date, skipping build: {container.imageName}")
+            return False
+
+        # Build the image
+        logger.info(f"Building image: {container.imageName}")
         common.run(
             [
                 "podman",
@@ -675,8 +1374,29 @@ cat pyproject.toml
                 self.config.workdir.path,
             ],
             print_output=True,
+            prefix=prefix,
+        )
+        self._record_build(
+            container.name,
+            {
+                "fingerprint": fingerprint,
+                "image_id": common.podman_image_id(container.imageName),
+                "pip_repo_name": self.pip_repo_name,
+            },
+        )
+        return True
+
+    def _build_pip_repo_names(self) -> list:
+        """Returns the pip repositories holding the dependencies of the images"""
+        names = [
+            self._build_manifest.get(container.name, {}).get("pip_repo_name")
+            for container in self.config.containers
+        ]
+        return list(
+            dict.fromkeys(name for name in names + [self.pip_repo_name] if name)
         )
 
+    @tracing.traced("build_proxy")
     def _build_proxy(self):
         # Create's the proxy script at
         # $WORKDIR/constructor/proxy/<container.name>/proxy.sh
@@ -691,33 +1411,6 @@ cat pyproject.toml
             logger.error("All services must use the same network")
             exit(1)
 
-        template_string = """#!/bin/sh
-SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
-
-# Get current -e and -x states
-_e=$(set +o | grep -q 'errexit'; echo $?)
-_x=$(set +o | grep -q 'xtrace'; echo $?)
-
-set -ex
-
-{% if container.proxies.python %}
-#<cachito-proxy> BEGIN
-export PIP_NO_BINARY=:all:
-# Special vars
-{%- for k, v in custom_envs.items() %}
-export {{ k }}={{ v }}
-{%- endfor %}
-#<cachito-proxy> END
-{% endif %}
-
-# Restore -e and -x states
-if [ $_e -eq 0 ]; then
-    set -e
-fi
-if [ $_x -eq 0 ]; then
-    set -x
-fi
-"""
         # Create the proxy script per container
         for container in self.config.containers:
             template_data = {}
@@ -736,15 +1429,15 @@ fi
             logger.info("Creating proxy script: " + _proxy_sh_path)
             common.create_file_from_template(
                 _proxy_sh_path,
-                template_string,
+                "proxy.sh",
                 template_data,
                 # Add new proxies to template_result
-                # TODO create new proxies instead of using the "cachito-pip-proxy"
-                lambda s: s.replace("<PIP_REPO_NAME>", "cachito-pip-proxy"),
+                lambda s: s.replace("<PIP_REPO_NAME>", self.pip_repo_name),
             )
 
-    def build(self):
-        self._pull_sources()
+    @tracing.traced("build")
+    def build(self, jobs: int = 1):
+        self._pull_sources(jobs)
         self._setup_package_managers()
 
         # HACK: if any self.config.proxies is true, then restart the proxies
@@ -756,10 +1449,18 @@ fi
             cli_server._check_dependencies()
             cli_server.restart(_cachito_repo_path)
 
+        # Each build gets its own pypi proxy repository, so only the
+        # dependencies requested by this build are captured. The repositories
+        # of the images that are not rebuilt are kept
+        self.pip_repo_name = create_build_pip_repo(
+            common.get_services(_cachito_repo_path),
+            keep=self.keep_pip_repos,
+            protect=self._build_pip_repo_names(),
+        )
+
         self._build_proxy()
 
-        for container in self.config.containers:
-            self._build_image(container)
+        self._build_images(jobs)
 
         dump_dependencies_from_cachito_pip_proxy_to_file(
             _cachito_repo_path,
@@ -767,6 +1468,7 @@ fi
                 self.config.workdir.path,
                 "requirements-from-proxy.txt",
             ),
+            self._build_pip_repo_names(),
         )
 
         # Success message
@@ -782,11 +1484,44 @@ fi
     default="./constructor.yml",
     help="Path to the constructor config file",
 )
-def cmd_run(config_file):
+@click.option(
+    "--keep-pip-repos",
+    default=_KEEP_BUILD_PIP_REPOS,
+    type=click.IntRange(min=1),
+    help=f"Number of per-build pip proxy repositories kept in Nexus (default: {_KEEP_BUILD_PIP_REPOS})",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=_DEFAULT_BUILD_JOBS,
+    type=click.IntRange(min=1),
+    help=f"Maximum number of containers built and sources pulled at the same time (default: {_DEFAULT_BUILD_JOBS})",
+)
+@click.option(
+    "--force-rebuild",
+    is_flag=True,
+    default=False,
+    help="Build all the images, even the ones whose inputs didn't change",
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the timings of the build steps to this Chrome trace JSON file. Open it in https://ui.perfetto.dev",
+)
+def cmd_run(config_file, keep_pip_repos, jobs, force_rebuild, trace):
     """creates a build from a constructor config file"""
-    builder = Builder(config_file)
-    logger.info("Workdir: " + builder.config.workdir.path)
-    builder.build()
+    if trace:
+        tracing.enable()
+    try:
+        builder = Builder(
+            config_file, keep_pip_repos=keep_pip_repos, force_rebuild=force_rebuild
+        )
+        logger.info("Workdir: " + builder.config.workdir.path)
+        builder.build(jobs=jobs)
+    finally:
+        if trace:
+            tracing.write(trace)
+            logger.info("Trace written to: " + trace)
 
 
 # Click
@@ -796,3 +1531,183 @@ def click_add_group(cli: click.Group) -> None:
     cmd_server = click.Group("builder", help="Container builder commands")
     cmd_server.add_command(name="run", cmd=cmd_run)
     cli.add_command(cmd_server)
+
+
+class TestBuilder:
+    def _builder(self, tmp_path, containerfiles: dict) -> Builder:
+        import yaml
+
+        config = {
+            "kind": "container",
+            "workdir": {"path": "./cache/"},
+            "packageManagers": {},
+            "sources": [],
+            "containers": [
+                {
+                    "name": name,
+                    "imageName": f"my.local/{name}",
+                    "containerfileContent": content,
+                    "restrictions": {"disableDnsResolution": False},
+                    "proxies": {"python": False, "golang": False},
+                    "sources_subpath": "sources",
+                    "podmanCacheEnabled": True,
+                }
+                for name, content in containerfiles.items()
+            ],
+        }
+        config_path = tmp_path / "constructor.yml"
+        config_path.write_text(yaml.safe_dump(config))
+        return Builder(str(config_path))
+
+    def test_container_dependencies(self, tmp_path):
+        builder = self._builder(
+            tmp_path,
+            {
+                "base": "FROM docker.io/redhat/ubi9:latest",
+                "main": "FROM localhost/my.local/base:latest",
+                "tools": "FROM my.local/base AS build\nFROM scratch\nCOPY --from=my.local/main /app /app",
+                "other": "FROM docker.io/redhat/ubi9:latest",
+            },
+        )
+        assert builder._container_dependencies() == {
+            "base": set(),
+            "main": {"base"},
+            "tools": {"base", "main"},
+            "other": set(),
+        }
+
+    def test_failure_skips_only_downstream(self, tmp_path, monkeypatch):
+        import pytest
+
+        builder = self._builder(
+            tmp_path,
+            {
+                "base": "FROM docker.io/redhat/ubi9:latest",
+                "main": "FROM my.local/base",
+                "other": "FROM docker.io/redhat/ubi9:latest",
+            },
+        )
+        built = []
+
+        def _build_image(container, prefix=None):
+            if container.name == "base":
+                raise Exception("podman build failed")
+            built.append(container.name)
+
+        monkeypatch.setattr(builder, "_build_image", _build_image)
+        with pytest.raises(SystemExit):
+            builder._build_images(jobs=2)
+        assert built == ["other"]
+
+    def test_build_skipped_when_unchanged(self, tmp_path, monkeypatch):
+        builder = self._builder(
+            tmp_path,
+            {"base": "FROM docker.io/redhat/ubi9:latest\nCOPY sources /sources"},
+        )
+        sources = tmp_path / "cache" / "sources"
+        sources.mkdir()
+        (sources / "app.py").write_text("print('hello')")
+        builds = []
+        cache_dir = tmp_path / "constructor-cache"
+        monkeypatch.setattr(common, "get_cache_dir", lambda: str(cache_dir))
+        monkeypatch.setattr(common, "is_running", lambda path: True)
+        monkeypatch.setattr(
+            common,
+            "podman_image_ids",
+            lambda images: {image: f"id-{image}" for image in images},
+        )
+        monkeypatch.setattr(common, "run", lambda cmd, **kwargs: builds.append(cmd))
+        container = builder.config.containers[0]
+
+        builder._build_image(container)
+        builder._build_image(container)
+        assert len(builds) == 1
+        # Outside of the build context
+        assert len(list((cache_dir / "build-manifests").iterdir())) == 1
+        assert not any(p.name.endswith(".json") for p in sources.parent.iterdir())
+
+        # A new builder reads the manifest of the previous one
+        (sources / "app.py").write_text("print('hello world')")
+        builder = Builder(builder.config_file_path)
+        builder._build_image(container)
+        builder._build_image(container)
+        assert len(builds) == 2
+
+        builder.force_rebuild = True
+        builder._build_image(container)
+        assert len(builds) == 3
+
+    def test_python_resolution_cached(self, tmp_path, monkeypatch):
+        builder = self._builder(tmp_path, {})
+        builder.config.packageManagers = common.dotdict(
+            {
+                "python": {
+                    "pythonVersion": "^3.9",
+                    "includeDependencies": True,
+                    "dependencies": ["cryptography==41.0.5"],
+                }
+            }
+        )
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(
+            "cli_builder.ensure_poetry_venv", lambda: "/cache/poetry-venv/bin/poetry"
+        )
+        resolutions = []
+
+        def _run(cmd, **kwargs):
+            if cmd[0].endswith("extract-dependencies.sh"):
+                resolutions.append(cmd)
+                freeze = os.path.join(
+                    os.path.dirname(cmd[0]), "requirements-freeze.txt"
+                )
+                with open(freeze, "w") as f:
+                    f.write("cffi==1.16.0\ncryptography==41.0.5\n")
+
+        monkeypatch.setattr(common, "run", _run)
+        builder._setup_package_managers()
+        os.remove(
+            tmp_path / "cache/constructor/packagemanager/python/requirements-freeze.txt"
+        )
+        builder._setup_package_managers()
+        assert len(resolutions) == 1
+        assert (
+            tmp_path / "cache/constructor/packagemanager/python/requirements-freeze.txt"
+        ).read_text() == "cffi==1.16.0\ncryptography==41.0.5\n"
+
+    def test_python_resolution_without_sdist(self, tmp_path, monkeypatch):
+        import subprocess
+
+        import pytest
+
+        builder = self._builder(tmp_path, {})
+        builder.config.packageManagers = common.dotdict(
+            {
+                "python": {
+                    "pythonVersion": "^3.9",
+                    "includeDependencies": True,
+                    "dependencies": ["cryptography==41.0.5"],
+                }
+            }
+        )
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(
+            "cli_builder.ensure_poetry_venv", lambda: "/cache/poetry-venv/bin/poetry"
+        )
+        resolutions = []
+
+        def _run(cmd, **kwargs):
+            if cmd[0].endswith("extract-dependencies.sh"):
+                with open(cmd[0]) as f:
+                    assert "PIP_NO_BINARY=:all:" in f.read()
+                resolutions.append(cmd)
+                # The pip download of the pinned sdists failed
+                raise subprocess.CalledProcessError(1, cmd)
+
+        monkeypatch.setattr(common, "run", _run)
+        for _ in range(2):
+            with pytest.raises(subprocess.CalledProcessError):
+                builder._setup_package_managers()
+        assert len(resolutions) == 2
+        assert not os.path.exists(
+            get_python_resolution_path(["cryptography==41.0.5"], "^3.9")
+        )
@@ -2,55 +2,356 @@ import base64
 import json as json_lib
 
 import click
-import requests
+
+import common
+import http_client
 
 # TODO refactor this entire file
 
+# Cachito API URL. Discovered from the running services when empty
 cachito_url = ""
 cert_url = ""
 
+# Replacements applied to the responses content, as (old, new) pairs.
+# Example: [("http://cachito-nexus:8081", "http://localhost:8082")]
+content_replacements = []
+
+_cachito_repo_path = common.get_cachito_repository_path()
+
 # %% Setup session
-requests_s = requests.Session()
-requests_s.verify = False
-requests.packages.urllib3.disable_warnings()
+requests_s = http_client.get_session("cachito")
+
+
+# Read size of the streamed downloads
+_DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# States after which a request doesn't change anymore
+_TERMINAL_STATES = ("complete", "failed", "stale")
+# Poll interval of each request, in seconds. It starts at the minimum and
+# grows while the request state doesn't change
+_WAIT_POLL_MIN = 1
+_WAIT_POLL_MAX = 30
+_WAIT_POLL_FACTOR = 1.5
+# Maximum number of requests polled at the same time
+_WAIT_JOBS = 8
+# Maximum number of requests submitted at the same time
+_SUBMIT_JOBS = 4
+# Requests listed per page
+_LIST_PAGE_SIZE = 100
+# Package managers of the new requests, see _new_request_data()
+_NEW_REQUEST_PKG_MANAGERS = ("pip", "gomod")
+
+
+class CachitoError(Exception):
+    pass
 
 
 # %% Helpers
+def get_cachito_url() -> str:
+    """Returns the Cachito API URL, from the running services by default"""
+    if cachito_url:
+        return cachito_url
+    # The discovery is cached, see common.get_services()
+    services = common.get_services(_cachito_repo_path)
+    return services["cachito"]["url_local"] + "/api/v1"
+
+
 def config_replace_content(content: str):
-    # Do transformations here...
+    """Apply the content_replacements to a string"""
+    for old, new in content_replacements:
+        content = content.replace(old, new)
     return content
 
 
-def request_get(*args, **kwargs):
-    """Get request and replace content"""
-    request = requests_s.get(*args, **kwargs)
+def _replace_json_content(obj):
+    """Apply the content_replacements to the strings of a parsed JSON"""
+    if isinstance(obj, str):
+        return config_replace_content(obj)
+    if isinstance(obj, list):
+        return [_replace_json_content(item) for item in obj]
+    if isinstance(obj, dict):
+        return {
+            config_replace_content(key): _replace_json_content(value)
+            for key, value in obj.items()
+        }
+    return obj
+
+
+def _response_json(request):
+    """Decode the response JSON once, and replace its content"""
     try:
-        # Get json
-        j_obj = request.json()
-        j_str = json_lib.dumps(j_obj, indent=4, sort_keys=True)
-        # Replace
-        j_str = config_replace_content(j_str)
-        json_obj = json_lib.loads(j_str)
+        json_obj = request.json()
     except json_lib.decoder.JSONDecodeError:
-        json_obj = {}
-    text = config_replace_content(request.text)
-    return (request, text, json_obj)
+        return {}
+    if content_replacements:
+        json_obj = _replace_json_content(json_obj)
+    return json_obj
+
+
+def request_get(*args, **kwargs):
+    """Get request and replace content
+
+    Returns:
+        tuple: (response, JSON)
+    """
+    request = requests_s.get(*args, **kwargs)
+    return (request, _response_json(request))
+
+
+def request_get_text(*args, **kwargs):
+    """Get request and replace content, for the non-JSON responses
+
+    Returns:
+        tuple: (response, text)
+    """
+    request = requests_s.get(*args, **kwargs)
+    return (request, config_replace_content(request.text))
 
 
 def request_post(*args, **kwargs):
-    """Post request and replace content"""
-    request = requests.post(*args, **kwargs)
-    try:
-        # Get json
-        j_obj = request.json()
-        j_str = json_lib.dumps(j_obj, indent=4, sort_keys=True)
-        # Replace
-        j_str = config_replace_content(j_str)
-        json_obj = json_lib.loads(j_str)
-    except json_lib.decoder.JSONDecodeError:
-        json_obj = {}
-    text = config_replace_content(request.text)
-    return (request, text, json_obj)
+    """Post request and replace content
+
+    Returns:
+        tuple: (response, JSON)
+    """
+    request = requests_s.post(*args, **kwargs)
+    return (request, _response_json(request))
+
+
+def _safe_tar_members(tar, path: str):
+    """Iterate over the archive members, failing on the ones extracted outside of path
+
+    Only used when tarfile has no extraction filters (Python < 3.11.4).
+    """
+    import os
+    import tarfile
+
+    for member in tar:
+        target = os.path.realpath(os.path.join(path, member.name))
+        if not target.startswith(os.path.realpath(path) + os.sep):
+            raise tarfile.TarError(f"Member outside of the output: {member.name}")
+        if not (member.isfile() or member.isdir()):
+            raise tarfile.TarError(f"Unsupported member type: {member.name}")
+        yield member
+
+
+def wait_for_requests(request_ids, timeout: float = None):
+    """Wait until the requests reach a terminal state
+
+    All the requests are tracked in a single loop. Each one is polled at its
+    own interval, which grows while its state doesn't change, and the ones
+    due are polled concurrently on the pooled session.
+
+    Args:
+        request_ids (list): Cachito request IDs
+        timeout (float): Maximum time to wait, in seconds. None waits forever
+
+    Yields:
+        dict: The request data, as soon as it is complete, failed or stale.
+              Unknown requests have the "not_found" state
+
+    Raises:
+        TimeoutError: If some requests are still pending after the timeout
+    """
+    import concurrent.futures
+    import time
+
+    import requests
+
+    base_url = get_cachito_url()
+
+    def _poll(request_id):
+        try:
+            r = requests_s.get(f"{base_url}/requests/{request_id}")
+        except requests.RequestException:
+            # e.g. the connection was reset, poll it again later. The
+            # timeout bounds the wait
+            return None
+        if r.status_code == 404:
+            return {"id": request_id, "state": "not_found"}
+        if r.status_code != 200:
+            # Transient error, poll it again later
+            return None
+        return r.json()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # request ID: [next poll time, interval, last state]
+    pending = {
+        request_id: [time.monotonic(), _WAIT_POLL_MIN, None]
+        for request_id in dict.fromkeys(request_ids)
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_WAIT_JOBS) as executor:
+        while pending:
+            now = time.monotonic()
+            due = [rid for rid, (poll_at, _, _) in pending.items() if poll_at <= now]
+            for request_id, request in zip(due, executor.map(_poll, due)):
+                if request and request["state"] in _TERMINAL_STATES + ("not_found",):
+                    del pending[request_id]
+                    yield request
+                    continue
+                poll = pending[request_id]
+                state = request and (request["state"], request.get("state_reason"))
+                if state != poll[2]:
+                    poll[1] = _WAIT_POLL_MIN
+                else:
+                    poll[1] = min(poll[1] * _WAIT_POLL_FACTOR, _WAIT_POLL_MAX)
+                poll[0] = time.monotonic() + poll[1]
+                poll[2] = state
+            if not pending:
+                break
+
+            next_poll_at = min(poll_at for poll_at, _, _ in pending.values())
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(
+                        f"Requests still pending: {', '.join(map(str, pending))}"
+                    )
+                next_poll_at = min(next_poll_at, deadline)
+            time.sleep(max(next_poll_at - time.monotonic(), 0))
+
+
+def _new_request_data(repo: str, ref: str, pkg_manager: str) -> dict:
+    """JSON data of a new request"""
+    # Packages
+    # swich case for [pip, gomod]
+    if pkg_manager == "pip":
+        packages = {"pip": [{"path": "."}]}
+    elif pkg_manager == "gomod":
+        packages = {"gomod": [{"path": "."}]}
+    else:
+        raise Exception("Not implemented")
+    return {
+        "repo": repo,
+        "ref": ref,
+        "pkg_managers": [pkg_manager],
+        "packages": packages,
+    }
+
+
+def _normalize_repo(repo: str) -> str:
+    """Same URL for 'https://host/org/repo', 'https://host/org/repo.git/', etc"""
+    repo = repo.strip().rstrip("/")
+    return repo[: -len(".git")] if repo.endswith(".git") else repo
+
+
+def iter_requests(**filters):
+    """Iterate over all the requests, following the pagination
+
+    Args:
+        filters: Filters applied by the server. Example: repo, ref, state,
+                 pkg_manager
+
+    Yields:
+        dict: Request data, as each page arrives
+
+    Raises:
+        CachitoError: If a page can't be read
+    """
+    params = {key: value for key, value in filters.items() if value}
+    params["per_page"] = _LIST_PAGE_SIZE
+    page = 1
+    while True:
+        r = requests_s.get(
+            f"{get_cachito_url()}/requests", params={**params, "page": page}
+        )
+        if r.status_code != 200:
+            raise CachitoError(
+                f"Error listing requests: {r.status_code}: {r.text.strip()}"
+            )
+        j = r.json()
+        yield from j["items"]
+        # Only the page number is used from 'next', its host may not be
+        # reachable from here
+        if not j.get("meta", {}).get("next"):
+            return
+        page += 1
+
+
+def _find_complete_request(repo: str, ref: str, pkg_manager: str):
+    """Find a complete request for the same repo, ref and package manager
+
+    Returns:
+        dict: The request data. None if there is none
+    """
+    # The server 'repo' filter is an exact match, and the same repository
+    # may have been requested as '<url>', '<url>.git', '<url>/', etc
+    for item in iter_requests(ref=ref, state="complete", pkg_manager=pkg_manager):
+        # Don't rely only on the server filters
+        if (
+            _normalize_repo(item["repo"]) == _normalize_repo(repo)
+            and item["ref"] == ref
+            and item["pkg_managers"] == [pkg_manager]
+            and item["state"] == "complete"
+        ):
+            return item
+    return None
+
+
+def submit_requests(
+    entries: list, jobs: int = _SUBMIT_JOBS, reuse: bool = True
+) -> list:
+    """Submit many requests, skipping the duplicated ones
+
+    The entries are normalized and de-duplicated first. Then, for each
+    unique one, a complete request for the same repo, ref and package
+    manager is reused, or a new request is created. The unique entries are
+    handled concurrently, up to 'jobs' at a time.
+
+    Args:
+        entries (list): Requests to submit. Example:
+                        [{"repo": "https://github.com/org/app", "ref": "<commit>", "pkg_manager": "pip"}]
+        jobs (int): Maximum number of entries handled at the same time
+        reuse (bool): Reuse the complete requests
+
+    Returns:
+        list: One result per unique entry, in the entries order. Each one
+              has the entry 'repo', 'ref' and 'pkg_manager', the request
+              'id' and 'state', 'reused' and 'error' (None on success)
+    """
+    import concurrent.futures
+
+    unique = {}
+    for entry in entries:
+        repo, ref, pkg_manager = (
+            str(entry[key]).strip() for key in ("repo", "ref", "pkg_manager")
+        )
+        key = (_normalize_repo(repo), ref, pkg_manager)
+        unique.setdefault(key, (repo, ref, pkg_manager))
+
+    base_url = get_cachito_url()
+
+    def _submit(repo, ref, pkg_manager) -> dict:
+        result = {
+            "repo": repo,
+            "ref": ref,
+            "pkg_manager": pkg_manager,
+            "id": None,
+            "state": None,
+            "reused": False,
+            "error": None,
+        }
+        try:
+            request = _find_complete_request(repo, ref, pkg_manager) if reuse else None
+        except CachitoError as e:
+            result["error"] = str(e)
+            return result
+        if request:
+            result["reused"] = True
+        else:
+            r = requests_s.post(
+                f"{base_url}/requests",
+                json=_new_request_data(repo, ref, pkg_manager),
+            )
+            if r.status_code not in (200, 201):
+                result["error"] = f"{r.status_code}: {r.text.strip()}"
+                return result
+            request = r.json()
+        result["id"] = request["id"]
+        result["state"] = request["state"]
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda args: _submit(*args), unique.values()))
 
 
 def helper_print_json(j):
@@ -60,24 +361,34 @@ def helper_print_json(j):
 # %% CLI
 @click.command()
 @click.option("--repo", default=None, help="Repository URL")
+@click.option("--ref", default=None, help="Repository reference")
+@click.option(
+    "--state",
+    default=None,
+    help="Request state",
+    type=click.Choice(["in_progress", "complete", "failed", "stale"]),
+)
+@click.option("--pkg-manager", default=None, help="Package manager. Example: pip")
 @click.option("--json", default=False, is_flag=True, help="Print JSON")
-def cmd_cachito_list(repo, json):
+def cmd_cachito_list(repo, ref, state, pkg_manager, json):
     """List requests"""
-    if repo:
-        r, t, j = request_get(f"{cachito_url}/requests", params={"repo": repo})
-    else:
-        r, t, j = request_get(f"{cachito_url}/requests")
+    import sys
 
-    if json:
-        helper_print_json(j)
-    else:
-        # Print table with: items[*][id,pkg_managers,state,repo]
-        print("ID\tState\t\tType\tRepo")
-        for item in j["items"]:
-            _tmp_pkg_managers = ",".join(item["pkg_managers"])
-            print(
-                f"{item['id']}\t{item['state'].ljust(8)}\t{_tmp_pkg_managers}\t{item['repo']}"
-            )
+    items = iter_requests(repo=repo, ref=ref, state=state, pkg_manager=pkg_manager)
+    try:
+        if json:
+            common.print_json_stream(items)
+        else:
+            # Print table with: items[*][id,pkg_managers,state,repo]
+            print("ID\tState\t\tType\tRepo")
+            for item in items:
+                _tmp_pkg_managers = ",".join(item["pkg_managers"])
+                print(
+                    f"{item['id']}\t{item['state'].ljust(8)}\t{_tmp_pkg_managers}\t{item['repo']}"
+                )
+    except CachitoError as e:
+        print(e)
+        sys.exit(1)
 
 
 @click.command()
@@ -85,7 +396,7 @@ def cmd_cachito_list(repo, json):
 @click.option("--json", default=False, is_flag=True, help="Print JSON")
 def cmd_cachito_describe(request_id, json):
     """Describe a request"""
-    r, t, j = request_get(f"{cachito_url}/requests/{request_id}")
+    r, j = request_get(f"{get_cachito_url()}/requests/{request_id}")
     if json:
         helper_print_json(j)
     else:
@@ -110,7 +421,7 @@ def cmd_cachito_describe(request_id, json):
 @click.argument("request_id", type=int)
 def cmd_cachito_logs(request_id):
     """Log of a request"""
-    r, t, j = request_get(f"{cachito_url}/requests/{request_id}/logs")
+    r, t = request_get_text(f"{get_cachito_url()}/requests/{request_id}/logs")
     print(t)
 
 
@@ -119,7 +430,7 @@ def cmd_cachito_logs(request_id):
 @click.option("--json", default=False, is_flag=True, help="Print JSON")
 def cmd_cachito_configuration_files(request_id, json):
     """Configuration files of a request"""
-    r, t, j = request_get(f"{cachito_url}/requests/{request_id}/configuration-files")
+    r, j = request_get(f"{get_cachito_url()}/requests/{request_id}/configuration-files")
     if json:
         helper_print_json(j)
     else:
@@ -149,25 +460,9 @@ def cmd_cachito_configuration_files(request_id, json):
 @click.option("--json", default=False, is_flag=True, help="Print JSON")
 def cmd_cachito_new(repo, ref, pkg_manager, json):
     """Create a new request"""
-
-    # Packages
-    # swich case for [pip, gomod]
-    if pkg_manager == "pip":
-        packages = {"pip": [{"path": "."}]}
-    elif pkg_manager == "gomod":
-        packages = {"gomod": [{"path": "."}]}
-    else:
-        raise Exception("Not implemented")
-
     # Send JSON data
-    r, t, j = request_post(
-        f"{cachito_url}/requests",
-        json={
-            "repo": repo,
-            "ref": ref,
-            "pkg_managers": [pkg_manager],
-            "packages": packages,
-        },
+    r, j = request_post(
+        f"{get_cachito_url()}/requests", json=_new_request_data(repo, ref, pkg_manager)
     )
     if json:
         helper_print_json(j)
@@ -181,15 +476,122 @@ def cmd_cachito_new(repo, ref, pkg_manager, json):
             helper_print_json(j)
 
 
+@click.command()
+@click.argument("request_ids", type=int, nargs=-1, required=True)
+@click.option(
+    "--timeout", type=float, default=None, help="Maximum time to wait, in seconds"
+)
+@click.option("--json", default=False, is_flag=True, help="Print JSON")
+def cmd_cachito_wait(request_ids, timeout, json):
+    """Wait for requests to complete
+
+    Print each request as soon as it is complete, failed or stale. Exit
+    with an error if any of them is not complete.
+    """
+    import sys
+
+    all_complete = True
+    if not json:
+        print("ID\tState\t\tReason")
+    try:
+        for request in wait_for_requests(request_ids, timeout):
+            all_complete = all_complete and request["state"] == "complete"
+            if json:
+                print(json_lib.dumps(request, sort_keys=True), flush=True)
+            else:
+                print(
+                    f"{request['id']}\t{request['state'].ljust(8)}\t{request.get('state_reason', '')}",
+                    flush=True,
+                )
+    except TimeoutError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if not all_complete:
+        sys.exit(1)
+
+
+@click.command()
+@click.argument("manifest", type=click.File("r"), required=True)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=_SUBMIT_JOBS,
+    help="Maximum number of requests submitted at the same time",
+)
+@click.option(
+    "--no-reuse",
+    default=False,
+    is_flag=True,
+    help="Always create new requests, even if there is a complete one",
+)
+@click.option("--json", default=False, is_flag=True, help="Print JSON")
+def cmd_cachito_new_batch(manifest, jobs, no_reuse, json):
+    """Create the requests of a manifest
+
+    The manifest is a YAML (or JSON) list of requests, each one with the
+    'repo', 'ref' and 'pkg_manager' keys. Duplicated requests are submitted
+    only once, and complete requests for the same repo, ref and package
+    manager are reused.
+    """
+    import sys
+
+    import yaml
+
+    entries = yaml.safe_load(manifest) or []
+    if isinstance(entries, dict):
+        entries = entries.get("requests") or []
+    for i, entry in enumerate(entries):
+        missing = [
+            key
+            for key in ("repo", "ref", "pkg_manager")
+            if not isinstance(entry, dict) or not entry.get(key)
+        ]
+        if missing:
+            print(f"Error: manifest entry {i} is missing: {', '.join(missing)}")
+            sys.exit(1)
+        # e.g. 'ref: 1234567' is loaded as a number
+        entries[i] = {key: str(value).strip() for key, value in entry.items()}
+        if entries[i]["pkg_manager"] not in _NEW_REQUEST_PKG_MANAGERS:
+            print(
+                f"Error: manifest entry {i} has an unsupported pkg_manager: {entries[i]['pkg_manager']}."
+                f" Supported: {', '.join(_NEW_REQUEST_PKG_MANAGERS)}"
+            )
+            sys.exit(1)
+
+    results = submit_requests(entries, jobs=jobs, reuse=not no_reuse)
+    if json:
+        helper_print_json(results)
+    else:
+        print("ID\tState\t\tAction\tType\tRepo\tRef")
+        for result in results:
+            action = "reused" if result["reused"] else "created"
+            if result["error"]:
+                action = "error"
+            print(
+                f"{result['id']}\t{str(result['state']).ljust(8)}\t{action}\t{result['pkg_manager']}\t{result['repo']}\t{result['ref']}"
+            )
+        for result in results:
+            if result["error"]:
+                print(
+                    f"Error creating {result['repo']}@{result['ref']}: {result['error']}"
+                )
+    if any(result["error"] for result in results):
+        sys.exit(1)
+
+
 @click.command()
 @click.argument("request_id", type=int, required=True)
 @click.argument("output_dir", type=click.Path(exists=True), required=True)
 def cmd_cachito_download(request_id, output_dir):
     """Download a request"""
+    import concurrent.futures
     import os
     import sys
     import tarfile
 
+    import urllib3
+
     _abs_output = os.path.abspath(output_dir)
 
     # fail if output dir is not empty
@@ -197,33 +599,56 @@ def cmd_cachito_download(request_id, output_dir):
         print(f"Error: Output directory '{_abs_output}' is not empty")
         sys.exit(1)
 
-    print(f"Downloading to {_abs_output}")
-    r = requests_s.get(f"{cachito_url}/requests/{request_id}/download", stream=True)
-    print(f"url: {r.url}")
-    if r.status_code == 200:
-        import tempfile
-
-        _tmp_tar_gz_file = tempfile.NamedTemporaryFile()
-        with open(_tmp_tar_gz_file.name, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                f.write(chunk)
-        tar = tarfile.open(_tmp_tar_gz_file.name, "r:gz")
-        tar.extractall(path=_abs_output)
-        tar.close()
-    else:
-        print(f"Error downloading request {request_id}")
-
-    if cert_url:
-        print("Downloading the 'cert' file")
-        _cert_r = requests_s.get(cert_url, stream=True)
-        if _cert_r.status_code == 200:
-            with open(os.path.join(_abs_output, "package-index-ca.pem"), "wb") as f:
-                for chunk in _cert_r.iter_content(chunk_size=1024):
-                    f.write(chunk)
-            # print("Done")
-
-    print("Generating the 'cachito.env' file")
-    _describe_r, _, _describe_j = request_get(f"{cachito_url}/requests/{request_id}")
+    def _get_cert():
+        _cert_r = requests_s.get(cert_url)
+        return _cert_r.content if _cert_r.status_code == 200 else None
+
+    # The cert and the request data are small, get them during the download
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        cert_future = executor.submit(_get_cert) if cert_url else None
+        describe_future = executor.submit(
+            request_get, f"{get_cachito_url()}/requests/{request_id}"
+        )
+
+        print(f"Downloading to {_abs_output}")
+        r = requests_s.get(
+            f"{get_cachito_url()}/requests/{request_id}/download", stream=True
+        )
+        print(f"url: {r.url}")
+        if r.status_code == 200:
+            # Extract while downloading, the archive is not written to disk
+            r.raw.decode_content = True
+            try:
+                with tarfile.open(
+                    fileobj=r.raw, mode="r|gz", bufsize=_DOWNLOAD_BUFFER_SIZE
+                ) as tar:
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(path=_abs_output, filter="data")
+                    else:
+                        tar.extractall(
+                            path=_abs_output,
+                            members=_safe_tar_members(tar, _abs_output),
+                        )
+            except (
+                tarfile.TarError,
+                EOFError,
+                OSError,
+                urllib3.exceptions.HTTPError,
+            ) as e:
+                print(f"Error extracting request {request_id}: {e}")
+                sys.exit(1)
+        else:
+            print(f"Error downloading request {request_id}")
+
+        if cert_future:
+            print("Downloading the 'cert' file")
+            cert = cert_future.result()
+            if cert is not None:
+                with open(os.path.join(_abs_output, "package-index-ca.pem"), "wb") as f:
+                    f.write(cert)
+
+        print("Generating the 'cachito.env' file")
+        _describe_r, _describe_j = describe_future.result()
     if _describe_r.status_code == 200:
         pip_index_url = _describe_j["environment_variables"]["PIP_INDEX_URL"]
 
@@ -243,3 +668,322 @@ def cmd_cachito_download(request_id, output_dir):
         # print("Done")
     else:
         print("Error generating 'cachito.env' file")
+
+
+# Click
+# ====================
+def click_add_group(cli: click.Group) -> None:
+    """Add the group to the CLI"""
+    cmd_cachito = click.Group("cachito", help="Cachito requests commands")
+    cmd_cachito.add_command(name="list", cmd=cmd_cachito_list)
+    cmd_cachito.add_command(name="describe", cmd=cmd_cachito_describe)
+    cmd_cachito.add_command(name="logs", cmd=cmd_cachito_logs)
+    cmd_cachito.add_command(
+        name="configuration-files", cmd=cmd_cachito_configuration_files
+    )
+    cmd_cachito.add_command(name="new", cmd=cmd_cachito_new)
+    cmd_cachito.add_command(name="new-batch", cmd=cmd_cachito_new_batch)
+    cmd_cachito.add_command(name="wait", cmd=cmd_cachito_wait)
+    cmd_cachito.add_command(name="download", cmd=cmd_cachito_download)
+    cli.add_command(cmd_cachito)
+
+
+class TestCachito:
+    def test_wait_for_requests(self, monkeypatch):
+        import http.server
+        import threading
+
+        import pytest
+
+        monkeypatch.setattr("cli_cachito._WAIT_POLL_MIN", 0.01)
+        monkeypatch.setattr("cli_cachito._WAIT_POLL_MAX", 0.05)
+        # request ID: states returned by each poll, the last one is repeated
+        states = {
+            1: ["in_progress", "in_progress", "complete"],
+            2: ["in_progress"] * 6 + ["failed"],
+            3: ["complete"],
+        }
+        polls = {request_id: 0 for request_id in states}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                request_id = int(self.path.split("/")[-1])
+                if request_id not in states:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                polls[request_id] += 1
+                request_states = states[request_id]
+                state = request_states[min(polls[request_id], len(request_states)) - 1]
+                body = json_lib.dumps({"id": request_id, "state": state}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(
+            "cli_cachito.cachito_url", f"http://127.0.0.1:{server.server_port}/api/v1"
+        )
+        try:
+            done = [
+                (request["id"], request["state"])
+                for request in wait_for_requests([1, 2, 3, 3, 4], timeout=10)
+            ]
+            assert sorted(done) == [
+                (1, "complete"),
+                (2, "failed"),
+                (3, "complete"),
+                (4, "not_found"),
+            ]
+            # The ones that finish first are returned first
+            assert done.index((2, "failed")) == 3
+            assert polls == {1: 3, 2: 7, 3: 1}
+
+            states[5] = ["in_progress"]
+            polls[5] = 0
+            with pytest.raises(TimeoutError, match="pending: 5"):
+                list(wait_for_requests([5], timeout=0.2))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_wait_for_requests_connection_error(self, monkeypatch):
+        import requests
+
+        monkeypatch.setattr("cli_cachito._WAIT_POLL_MIN", 0.01)
+        responses = [
+            requests.ConnectionError("Connection reset by peer"),
+            type(
+                "Response",
+                (),
+                {"status_code": 200, "json": lambda _: {"id": 1, "state": "complete"}},
+            )(),
+        ]
+
+        class Session:
+            def get(self, url):
+                response = responses.pop(0)
+                if isinstance(response, Exception):
+                    raise response
+                return response
+
+        monkeypatch.setattr("cli_cachito.requests_s", Session())
+        monkeypatch.setattr("cli_cachito.cachito_url", "http://cachito/api/v1")
+        # Polled again after the error
+        assert list(wait_for_requests([1], timeout=10)) == [
+            {"id": 1, "state": "complete"}
+        ]
+        assert responses == []
+
+    def test_submit_requests(self, monkeypatch):
+        import http.server
+        import threading
+        import urllib.parse
+
+        existing = {
+            "id": 1,
+            "repo": "https://github.com/org/app.git",
+            "ref": "a" * 40,
+            "pkg_managers": ["pip"],
+            "state": "complete",
+        }
+        created = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, data):
+                body = json_lib.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                if query["ref"] == ["c" * 40]:
+                    self._send(500, {"error": "Internal Server Error"})
+                    return
+                # Exact match filters, like Cachito
+                filters = {
+                    "repo": existing["repo"],
+                    "ref": existing["ref"],
+                    "state": existing["state"],
+                    "pkg_manager": existing["pkg_managers"][0],
+                }
+                matches = all(
+                    query.get(key, [value]) == [value] for key, value in filters.items()
+                )
+                self._send(200, {"items": [existing] if matches else []})
+
+            def do_POST(self):
+                data = json_lib.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                created.append(data)
+                self._send(201, {"id": 100 + len(created), "state": "in_progress"})
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(
+            "cli_cachito.cachito_url", f"http://127.0.0.1:{server.server_port}/api/v1"
+        )
+        entries = [
+            {
+                "repo": "https://github.com/org/app/",
+                "ref": "a" * 40,
+                "pkg_manager": "pip",
+            },
+            {
+                "repo": "https://github.com/org/lib",
+                "ref": "b" * 40,
+                "pkg_manager": "pip",
+            },
+            {
+                "repo": " https://github.com/org/lib.git",
+                "ref": "b" * 40,
+                "pkg_manager": "pip",
+            },
+            {
+                "repo": "https://github.com/org/app",
+                "ref": "a" * 40,
+                "pkg_manager": "gomod",
+            },
+            # The lookup fails, only this entry has an error
+            {
+                "repo": "https://github.com/org/tool",
+                "ref": "c" * 40,
+                "pkg_manager": "pip",
+            },
+        ]
+        try:
+            results = submit_requests(entries)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert [(r["repo"], r["pkg_manager"], r["reused"]) for r in results] == [
+            ("https://github.com/org/app/", "pip", True),
+            ("https://github.com/org/lib", "pip", False),
+            ("https://github.com/org/app", "gomod", False),
+            ("https://github.com/org/tool", "pip", False),
+        ]
+        assert results[0]["id"] == 1
+        assert sorted(r["id"] for r in results[1:3]) == [101, 102]
+        assert [r["error"] for r in results[:3]] == [None] * 3
+        assert results[3]["error"].startswith("Error listing requests: 500")
+        assert sorted(data["pkg_managers"][0] for data in created) == ["gomod", "pip"]
+
+    def test_new_batch_manifest(self, runner, monkeypatch, tmp_path):
+        submitted = []
+
+        def _submit_requests(entries, jobs, reuse):
+            submitted.extend(entries)
+            return []
+
+        monkeypatch.setattr("cli_cachito.submit_requests", _submit_requests)
+        manifest = tmp_path / "manifest.yml"
+        manifest.write_text(
+            "- {repo: https://github.com/org/app, ref: 1234567, pkg_manager: pip}\n"
+        )
+        result = runner.invoke(cmd_cachito_new_batch, [str(manifest)])
+        assert result.exit_code == 0
+        # Loaded as a number, submitted as written
+        assert submitted == [
+            {
+                "repo": "https://github.com/org/app",
+                "ref": "1234567",
+                "pkg_manager": "pip",
+            }
+        ]
+
+        with manifest.open("a") as f:
+            f.write(
+                "- {repo: https://github.com/org/lib, ref: abc1234, pkg_manager: npm}\n"
+            )
+        result = runner.invoke(cmd_cachito_new_batch, [str(manifest)])
+        assert result.exit_code == 1
+        assert "entry 1 has an unsupported pkg_manager: npm" in result.output
+
+        result = runner.invoke(cmd_cachito_new_batch, [str(manifest), "-j", "0"])
+        assert result.exit_code == 2
+
+    def test_iter_requests(self, monkeypatch):
+        import http.server
+        import threading
+        import urllib.parse
+
+        total = 250
+        queries = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                queries.append(query)
+                page, per_page = int(query["page"][0]), int(query["per_page"][0])
+                ids = range((page - 1) * per_page, min(page * per_page, total))
+                body = json_lib.dumps(
+                    {
+                        "items": [{"id": i} for i in ids],
+                        "meta": {
+                            # Not reachable from the client
+                            "next": (
+                                f"http://cachito-api:8080/api/v1/requests?page={page + 1}"
+                                if page * per_page < total
+                                else None
+                            )
+                        },
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(
+            "cli_cachito.cachito_url", f"http://127.0.0.1:{server.server_port}/api/v1"
+        )
+        try:
+            items = list(iter_requests(state="complete", repo=None))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert [item["id"] for item in items] == list(range(total))
+        assert [query["page"] for query in queries] == [["1"], ["2"], ["3"]]
+        assert all(query["state"] == ["complete"] for query in queries)
+        assert all("repo" not in query for query in queries)
+
+    def test_replace_content(self, monkeypatch):
+        request = {
+            "id": 1,
+            "environment_variables": {"PIP_INDEX_URL": "http://nexus:8081/simple"},
+            "dependencies": [{"name": "six", "version": "1.16.0"}],
+        }
+        assert _replace_json_content(request) == request
+        monkeypatch.setattr(
+            "cli_cachito.content_replacements", [("nexus:8081", "localhost:8082")]
+        )
+        replaced = _replace_json_content(request)
+        assert replaced["environment_variables"] == {
+            "PIP_INDEX_URL": "http://localhost:8082/simple"
+        }
+        assert replaced["dependencies"] == request["dependencies"]
@@ -0,0 +1,575 @@
+"""
+Constructor daemon
+
+A long-running process executing the CLI commands, so the imports, the
+services discovery, the HTTP sessions, the Nexus index and the other
+in-memory caches are kept warm between commands.
+
+The CLI forwards the commands to the daemon over a Unix socket, in the
+cache directory, and runs them in-process when no daemon is running.
+The commands run one at a time, in the client's working directory and
+environment, and their output is streamed back to the client: the Python
+sys.stdout and sys.stderr, and the file descriptors 1 and 2 inherited by
+the child processes. When the client is interrupted (Ctrl-C), the command
+is interrupted too.
+
+The client side runs on every invocation, so this module only imports
+the standard library and click at load time.
+"""
+
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import click
+
+# Set it to run the commands in-process, even if a daemon is running
+_NO_DAEMON_ENV = "CONSTRUCTOR_NO_DAEMON"
+
+# Read size of the child processes output
+_PUMP_READ_SIZE = 64 * 1024
+# Seconds waiting for the child processes output after a command. Processes
+# left in the background (e.g. 'podman-compose up -d') may keep it open
+_PUMP_JOIN_TIMEOUT = 1
+
+# The streams of a command are written from several threads
+_send_lock = threading.Lock()
+
+
+def get_socket_path() -> str:
+    """Returns the path of the daemon socket"""
+    return os.path.abspath(os.path.join("./cache", "constructor.sock"))
+
+
+def _code_version() -> int:
+    """Identify the source code, a daemon running an older one is not used"""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    return max(
+        entry.stat().st_mtime_ns
+        for entry in os.scandir(src_dir)
+        if entry.name.endswith(".py")
+    )
+
+
+def _send(wfile, message: dict) -> None:
+    with _send_lock:
+        wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        wfile.flush()
+
+
+def _request(socket_path: str, message: dict):
+    """Send a request to the daemon
+
+    Yields:
+        dict: The messages sent back by the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            _send(f, message)
+            for line in f:
+                yield json.loads(line)
+
+
+def forward(args: list, socket_path: str = None, stdout=None, stderr=None):
+    """Run the command in the daemon, if it is running
+
+    Args:
+        args (list): CLI arguments. Example: ["nexus", "list-repos"]
+        socket_path (str): Daemon socket. Default: get_socket_path()
+        stdout: Where to write the command stdout. Default: sys.stdout
+        stderr: Where to write the command stderr. Default: sys.stderr
+
+    Returns:
+        int: The command exit code. None if the command was not run,
+             and must run in-process
+    """
+    if os.environ.get(_NO_DAEMON_ENV) or (args and args[0] == "daemon"):
+        return None
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    message = {
+        "action": "run",
+        "args": args,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "isatty": {"stdout": stdout.isatty(), "stderr": stderr.isatty()},
+        "code_version": _code_version(),
+    }
+    try:
+        # Closing the connection interrupts the command
+        for reply in _request(socket_path, message):
+            if "stdout" in reply:
+                stdout.write(reply["stdout"])
+                stdout.flush()
+            elif "stderr" in reply:
+                stderr.write(reply["stderr"])
+                stderr.flush()
+            elif "exit_code" in reply:
+                return reply["exit_code"]
+            elif "error" in reply:
+                print(f"constructor daemon: {reply['error']}", file=stderr)
+                return None
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Stale socket, the daemon is not running anymore
+        return None
+    except KeyboardInterrupt:
+        return 130
+    print("constructor daemon: connection closed", file=stderr)
+    return 1
+
+
+class _ClientStream(io.TextIOBase):
+    """Text stream sending the writes to the client"""
+
+    def __init__(self, wfile, name: str, isatty: bool):
+        self._wfile = wfile
+        self._name = name
+        self._isatty = isatty
+        self._client_gone = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        if text and not self._client_gone:
+            try:
+                _send(self._wfile, {self._name: text})
+            except OSError:
+                # e.g. the client was interrupted. The output is dropped
+                self._client_gone = True
+        return len(text)
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+
+@contextlib.contextmanager
+def _client_context(cwd: str, env: dict):
+    """Run in the client working directory and environment"""
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+class _ClientInterrupt(KeyboardInterrupt):
+    """The client was interrupted while its command was running"""
+
+
+def _pump(read_fd: int, stream) -> None:
+    """Copy the output of the child processes to a stream"""
+    import codecs
+
+    # A read may end in the middle of a multi-byte character
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(read_fd, "rb", buffering=0) as f:
+        while chunk := f.read(_PUMP_READ_SIZE):
+            stream.write(decoder.decode(chunk))
+    stream.write(decoder.decode(b"", final=True))
+
+
+@contextlib.contextmanager
+def _redirect_fds(stdout, stderr):
+    """Send the file descriptors 1 and 2 to the streams
+
+    Only for the child processes: Python writes to sys.stdout and
+    sys.stderr, which are redirected on their own.
+    """
+    saved_fds = {}
+    pumps = []
+    for fd, stream in ((1, stdout), (2, stderr)):
+        read_fd, write_fd = os.pipe()
+        saved_fds[fd] = os.dup(fd)
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        pump = threading.Thread(target=_pump, args=(read_fd, stream), daemon=True)
+        pump.start()
+        pumps.append(pump)
+    try:
+        yield
+    finally:
+        for fd, saved_fd in saved_fds.items():
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        for pump in pumps:
+            pump.join(timeout=_PUMP_JOIN_TIMEOUT)
+
+
+def _interrupt_children() -> None:
+    """Interrupt the child processes left by an interrupted command
+
+    e.g. the ones started while the interruption arrived. A Ctrl-C in a
+    terminal reaches them through the process group. Linux only: the
+    processes are listed from /proc
+    """
+    pid = str(os.getpid())
+    with contextlib.suppress(FileNotFoundError):
+        for entry in os.scandir("/proc"):
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(os.path.join(entry.path, "stat"), "r") as f:
+                    # The process name, in parentheses, may have spaces
+                    state, ppid = f.read().rsplit(")", 1)[1].split()[:2]
+            except (OSError, ValueError):
+                continue
+            if ppid == pid and state != "Z":
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(int(entry.name), signal.SIGINT)
+
+
+def _run_command(args: list, stdout, stderr) -> int:
+    """Run a CLI command, like 'constructor <args>' would"""
+    import main
+    import tracing
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+        stderr
+    ), _redirect_fds(stdout, stderr):
+        try:
+            main.cli.main(args, prog_name="constructor")
+        except _ClientInterrupt:
+            return 130
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code, file=sys.stderr)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            # e.g. 'builder run --trace' enables it
+            tracing.disable()
+    return 0
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        message = json.loads(self.rfile.readline())
+        daemon = self.server
+        action = message.get("action")
+
+        if action == "status":
+            _send(
+                self.wfile,
+                {
+                    "pid": os.getpid(),
+                    "uptime": time.monotonic() - daemon.started_at,
+                    "commands": daemon.commands,
+                },
+            )
+            return
+        if action == "stop":
+            daemon.stopping = True
+            _send(self.wfile, {"exit_code": 0})
+            return
+        if message.get("code_version") != daemon.code_version:
+            _send(self.wfile, {"error": "the source code changed, restart the daemon"})
+            return
+
+        daemon.commands += 1
+        isatty = message.get("isatty", {})
+        stdout = _ClientStream(self.wfile, "stdout", isatty.get("stdout", False))
+        stderr = _ClientStream(self.wfile, "stderr", isatty.get("stderr", False))
+        watcher = threading.Thread(target=self._watch_client, daemon=True)
+        daemon.set_running(True)
+        watcher.start()
+        try:
+            with _client_context(message["cwd"], message["env"]):
+                exit_code = _run_command(message["args"], stdout, stderr)
+        finally:
+            daemon.set_running(False)
+            # Wakes up the watcher
+            with contextlib.suppress(OSError):
+                self.connection.shutdown(socket.SHUT_RD)
+            watcher.join()
+        if daemon.interrupted:
+            # Not always seen by _run_command, click turns it into an exit
+            _interrupt_children()
+            exit_code = 130
+        with contextlib.suppress(OSError):
+            _send(self.wfile, {"exit_code": exit_code})
+
+    def _watch_client(self):
+        """Interrupt the command when the client closes the connection"""
+        with contextlib.suppress(OSError, ValueError):
+            while self.rfile.read(1):
+                pass
+        self.server.interrupt_command()
+
+
+class _DaemonServer(socketserver.UnixStreamServer):
+    def __init__(self, socket_path: str):
+        super().__init__(socket_path, _DaemonHandler)
+        os.chmod(socket_path, 0o600)
+        self.started_at = time.monotonic()
+        self.code_version = _code_version()
+        self.commands = 0
+        self.stopping = False
+        # Commands are only interrupted when the daemon handles SIGINT,
+        # which needs the main thread
+        self.can_interrupt = False
+        self._running = False
+        self._interrupt_requested = False
+        self.interrupted = False
+        self._interrupt_lock = threading.Lock()
+
+    def set_running(self, running: bool) -> None:
+        with self._interrupt_lock:
+            self._running = running
+            if running:
+                self.interrupted = False
+
+    def interrupt_command(self) -> None:
+        """Interrupt the running command, from another thread"""
+        with self._interrupt_lock:
+            if self._running and self.can_interrupt:
+                self._interrupt_requested = True
+                # To the main thread, so its blocking calls are interrupted
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+    def on_sigint(self, signum, frame):
+        if not self._interrupt_requested:
+            # Ctrl-C in the daemon terminal
+            raise KeyboardInterrupt
+        self._interrupt_requested = False
+        # Ignored if the command finished in the meantime
+        if self._running:
+            self.interrupted = True
+            raise _ClientInterrupt
+
+    def handle_error(self, request, client_address):
+        # e.g. the client was interrupted. Keep serving the next ones
+        import common
+
+        common.get_logger().warning(
+            f"Daemon request failed: {sys.exc_info()[1]!r}", exc_info=True
+        )
+
+
+def is_daemon_running(socket_path: str = None) -> bool:
+    """Check if a daemon is listening on the socket"""
+    try:
+        for _ in _request(socket_path or get_socket_path(), {"action": "status"}):
+            return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        pass
+    return False
+
+
+def serve(socket_path: str = None) -> None:
+    """Run the daemon until it is stopped
+
+    Args:
+        socket_path (str): Daemon socket. Default: get_socket_path()
+    """
+    import common
+
+    logger = common.get_logger()
+    socket_path = socket_path or get_socket_path()
+    if is_daemon_running(socket_path):
+        logger.error(f"The daemon is already running: {socket_path}")
+        exit(1)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    with _DaemonServer(socket_path) as daemon:
+        logger.info(f"Daemon listening on: {socket_path}")
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGINT, daemon.on_sigint)
+            daemon.can_interrupt = True
+        try:
+            while not daemon.stopping:
+                try:
+                    daemon.handle_request()
+                except _ClientInterrupt:
+                    # Interrupted right after its command finished
+                    pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+            if daemon.can_interrupt:
+                signal.signal(signal.SIGINT, previous_handler)
+    logger.info("Daemon stopped")
+
+
+# Commands
+# ====================
+@click.command()
+def cmd_start():
+    """Run the daemon in the foreground"""
+    serve()
+
+
+@click.command()
+def cmd_stop():
+    """Stop the daemon"""
+    if not is_daemon_running():
+        click.echo("The daemon is not running")
+        exit(0)
+    for _ in _request(get_socket_path(), {"action": "stop"}):
+        pass
+    click.echo("Daemon stopped")
+
+
+@click.command()
+def cmd_status():
+    """Show the status of the daemon"""
+    try:
+        status = next(_request(get_socket_path(), {"action": "status"}))
+    except (ConnectionRefusedError, FileNotFoundError):
+        click.echo("The daemon is not running")
+        exit(1)
+    click.echo(f"Socket   : {get_socket_path()}")
+    click.echo(f"PID      : {status['pid']}")
+    click.echo(f"Uptime   : {status['uptime']:.0f} seconds")
+    click.echo(f"Commands : {status['commands']}")
+
+
+# Click
+# ====================
+def click_add_group(cli: click.Group) -> None:
+    """Add the group to the CLI"""
+    cmd_daemon = click.Group(
+        "daemon", help="Daemon keeping the caches warm between commands"
+    )
+    cmd_daemon.add_command(name="start", cmd=cmd_start)
+    cmd_daemon.add_command(name="stop", cmd=cmd_stop)
+    cmd_daemon.add_command(name="status", cmd=cmd_status)
+    cli.add_command(cmd_daemon)
+
+
+class TestDaemon:
+    def test_forward(self, tmp_path, monkeypatch):
+        import threading
+
+        socket_path = str(tmp_path / "constructor.sock")
+        daemon = threading.Thread(target=serve, args=(socket_path,), daemon=True)
+        daemon.start()
+        while not is_daemon_running(socket_path):
+            time.sleep(0.01)
+
+        monkeypatch.setenv("CONSTRUCTOR_TEST_VALUE", "42")
+        monkeypatch.chdir(tmp_path)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        exit_code = forward(["nexus", "--help"], socket_path, stdout, stderr)
+        assert exit_code == 0
+        assert "Sonatype Nexus commands" in stdout.getvalue()
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        exit_code = forward(["nexus", "unknown"], socket_path, stdout, stderr)
+        assert exit_code == 2
+        assert "No such command 'unknown'" in stderr.getvalue()
+        assert os.getcwd() == str(tmp_path)
+
+        # The daemon itself is not forwarded
+        assert forward(["daemon", "status"], socket_path) is None
+
+        for _ in _request(socket_path, {"action": "stop"}):
+            pass
+        daemon.join(timeout=5)
+        assert not daemon.is_alive()
+        assert not os.path.exists(socket_path)
+        assert forward(["nexus", "--help"], socket_path) is None
+
+    def test_child_process_output(self, monkeypatch):
+        import subprocess
+
+        import common
+        import main
+
+        @click.command()
+        def cmd_echo():
+            common.run(["echo", "from run"], print_output=True)
+            subprocess.run(["sh", "-c", "echo from sh; echo error from sh >&2"])
+            os.system("echo from os.system")
+
+        monkeypatch.setattr(main, "cli", cmd_echo)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        assert _run_command([], stdout, stderr) == 0
+        assert stdout.getvalue() == "from run\nfrom sh\nfrom os.system\n"
+        assert stderr.getvalue() == "error from sh\n"
+
+    def test_client_interrupt(self, tmp_path):
+        import re
+        import subprocess
+
+        # A daemon in its own process, handling SIGINT in its main thread
+        socket_path = str(tmp_path / "constructor.sock")
+        script = (
+            "import sys, click, common, main, cli_daemon\n"
+            "@click.command()\n"
+            "def cmd_sleep():\n"
+            "    common.check_output(['sh', '-c', 'echo child $$ >&2; exec sleep 60'])\n"
+            "main.cli = cmd_sleep\n"
+            "cli_daemon.serve(sys.argv[1])\n"
+        )
+        daemon = subprocess.Popen(
+            [sys.executable, "-c", script, socket_path],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while not is_daemon_running(socket_path):
+                assert daemon.poll() is None
+                time.sleep(0.01)
+            message = {
+                "action": "run",
+                "args": [],
+                "cwd": str(tmp_path),
+                "env": dict(os.environ),
+                "code_version": _code_version(),
+            }
+            replies = _request(socket_path, message)
+            for reply in replies:
+                match = re.match(r"child (\d+)", reply.get("stderr", ""))
+                if match:
+                    break
+            child_pid = int(match.group(1))
+            # Like a Ctrl-C in the client
+            replies.close()
+
+            def _is_running(pid):
+                try:
+                    with open(f"/proc/{pid}/stat", "r") as f:
+                        return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+                except FileNotFoundError:
+                    return False
+
+            # The child is killed, and the daemon keeps serving
+            deadline = time.monotonic() + 10
+            while _is_running(child_pid):
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            assert is_daemon_running(socket_path)
+            for _ in _request(socket_path, {"action": "stop"}):
+                pass
+            assert daemon.wait(timeout=10) == 0
+        finally:
+            daemon.kill()
@@ -1,9 +1,9 @@
 import os
 
 import click
-import requests
 
 import common
+import nexus_index
 
 
 # Sonatype Nexus
@@ -13,7 +13,7 @@ import common
 @click.option(
     "--clone-path",
     "-p",
-    default=os.getcwd() + "/cache/cachito_repo",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
     help="Path where the Cachito repository is located",
 )
 def cmd_nexus_list_repos(clone_path, json):
@@ -21,10 +21,7 @@ def cmd_nexus_list_repos(clone_path, json):
     services = common.get_services(clone_path)
     nexus_url = services["nexus"]["url_local"]
 
-    r = requests.get(
-        f"{nexus_url}/service/rest/v1/repositories",
-        auth=common._nexus_auth(),
-    )
+    r = common._nexus_session().get(f"{nexus_url}/service/rest/v1/repositories")
     if r.status_code == 200:
         if json:
             common.print_json(r.json())
@@ -42,52 +39,27 @@ def cmd_nexus_list_repos(clone_path, json):
 @click.option(
     "--clone-path",
     "-p",
-    default=os.getcwd() + "/cache/cachito_repo",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
     help="Path where the Cachito repository is located",
 )
 def cmd_nexus_list_components(clone_path, repo_name, json):
     """List components in a Nexus repository"""
     services = common.get_services(clone_path)
-    nexus_url = services["nexus"]["url_local"]
-
-    def _pag_request(cont_token=None):
-        params = {
-            "repository": repo_name,
-        }
-        if cont_token:
-            params.update({"continuationToken": cont_token})
-        r = requests.get(
-            f"{nexus_url}/service/rest/v1/components",
-            params=params,
-            auth=common._nexus_auth(),
-        )
-        return r
-
-    # pagination using 'continuationToken'
-    full_items = []
-    cont_token = None
-    while True:
-        r = _pag_request(cont_token)
-
-        if r.status_code == 200:
-            full_items = full_items + r.json()["items"]
-        else:
-            print(f"Error: {r.status_code}")
-
-        cont_token = r.json()["continuationToken"]
-
-        if not cont_token:
-            break
 
     if json:
-        common.print_json(full_items)
+        common.print_json_stream(
+            common._nexus_iter_components(services, repo_name, fields=None)
+        )
     else:
         print("Components:")
-        components = full_items
+        components = [
+            (component["name"], component["version"])
+            for component in common._nexus_iter_components(services, repo_name)
+        ]
         # sort by name
-        components = sorted(components, key=lambda k: k["name"])
-        for component in components:
-            print(f"  - {component['name']}=={component['version']}")
+        components.sort(key=lambda k: k[0])
+        for name, version in components:
+            print(f"  - {name}=={version}")
 
 
 @click.command()
@@ -96,7 +68,7 @@ def cmd_nexus_list_components(clone_path, repo_name, json):
 @click.option(
     "--clone-path",
     "-p",
-    default=os.getcwd() + "/cache/cachito_repo",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
     help="Path where the Cachito repository is located",
 )
 def cmd_nexus_describe_repo(clone_path, repo_name, json):
@@ -104,9 +76,8 @@ def cmd_nexus_describe_repo(clone_path, repo_name, json):
     services = common.get_services(clone_path)
     nexus_url = services["nexus"]["url_local"]
 
-    r = requests.get(
-        f"{nexus_url}/service/rest/v1/repositories/{repo_name}/",
-        auth=common._nexus_auth(),
+    r = common._nexus_session().get(
+        f"{nexus_url}/service/rest/v1/repositories/{repo_name}/"
     )
     if r.status_code == 200:
         if json:
@@ -121,6 +92,57 @@ def cmd_nexus_describe_repo(clone_path, repo_name, json):
         print(f"Error: {r.status_code}")
 
 
+@click.command()
+@click.argument("repo_name", type=str, required=True)
+@click.option(
+    "--full",
+    default=False,
+    is_flag=True,
+    help="Walk the whole repository instead of only the new components",
+)
+@click.option(
+    "--clone-path",
+    "-p",
+    default=lambda: os.getcwd() + "/cache/cachito_repo",
+    help="Path where the Cachito repository is located",
+)
+def cmd_nexus_sync(clone_path, repo_name, full):
+    """Sync the local index with a Nexus repository"""
+    services = common.get_services(clone_path)
+    total = nexus_index.get_index().sync(services, repo_name, full=full)
+    print(f"Synced {total} components")
+
+
+@click.command()
+@click.argument("repo_name", type=str, required=True)
+@click.option("--name-prefix", default=None, help="Component name prefix")
+@click.option("--format", default=None, help="Component format. Example: pypi")
+@click.option(
+    "--downloaded-since",
+    default=None,
+    type=click.DateTime(),
+    help="Only components downloaded after this date (local time)",
+)
+@click.option("--json", default=False, is_flag=True, help="Print JSON")
+def cmd_nexus_query(repo_name, name_prefix, format, downloaded_since, json):
+    """Query the components of a repository from the local index
+
+    Run 'nexus sync' first to pull the repository data.
+    """
+    components = nexus_index.get_index().query(
+        repo_name,
+        name_prefix=name_prefix,
+        format=format,
+        downloaded_since=downloaded_since.timestamp() if downloaded_since else None,
+    )
+    if json:
+        common.print_json_stream(components)
+    else:
+        print("Components:")
+        for component in components:
+            print(f"  - {component['name']}=={component['version']}")
+
+
 # Click
 # ====================
 def click_add_group(cli: click.Group) -> None:
@@ -129,4 +151,6 @@ def click_add_group(cli: click.Group) -> None:
     cmd_nexus.add_command(name="list-repos", cmd=cmd_nexus_list_repos)
     cmd_nexus.add_command(name="list-components", cmd=cmd_nexus_list_components)
     cmd_nexus.add_command(name="describe-repo", cmd=cmd_nexus_describe_repo)
+    cmd_nexus.add_command(name="sync", cmd=cmd_nexus_sync)
+    cmd_nexus.add_command(name="query", cmd=cmd_nexus_query)
     cli.add_command(cmd_nexus)
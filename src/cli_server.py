@@ -1,9 +1,6 @@
 import os
-import time
 
 import click
-import pytest
-import yaml
 
 import common
 
@@ -12,23 +9,23 @@ logger = common.get_logger()
 
 _cachito_repo_path = common.get_cachito_repository_path()
 
+# Maximum time, in seconds, to wait for the services after starting them
+_START_TIMEOUT = 300
+
 
 def _check_dependencies():
-    # Check podman
-    if not common.check_executable("podman"):
-        logger.error("podman is not available in the PATH")
-        exit(1)
-    # Check podman-compose
-    if not common.check_executable("podman-compose"):
-        logger.error("podman-compose is not available in the PATH")
-        exit(1)
-    # Check git
-    if not common.check_executable("git"):
-        logger.error("git is not available in the PATH")
-        exit(1)
+    # Check podman, podman-compose and git
+    executables = ["podman", "podman-compose", "git"]
+    results = common.run_many({name: ["which", name] for name in executables})
+    for name in executables:
+        if results[name].exit_code != 0:
+            logger.error(f"{name} is not available in the PATH")
+            exit(1)
 
 
 def _get_compose_file_data(cachito_repo_path: str):
+    import yaml
+
     compose_file = None
     # Search for files, in order of preference
     for file in ["container-compose.yml", "podman-compose.yaml", "docker-compose.yml"]:
@@ -53,36 +50,33 @@ def start(cachito_repo_path: str):
     if not common.cachito_repo_exists(cachito_repo_path):
         # Clone cachito
         logger.info("Cloning Cachito repository")
-        common.run(["git", "clone", _global["cachito_git_url"], cachito_repo_path])
+        common.run(
+            ["git", "clone", _global["cachito_git_url"], cachito_repo_path],
+            print_output=True,
+        )
 
     logger.info("Fixing volume permissions")
     compose = _get_compose_file_data(cachito_repo_path)
 
     # Fix nexus permissions
-    nexus_uid = common.run(
-        [
-            "podman",
-            "run",
-            "-it",
-            "--rm",
-            "--entrypoint=",
-            compose["services"]["nexus"]["image"],
-            "id",
-            "-u",
-        ]
-    ).stdout.strip()
-    nexus_gid = common.run(
-        [
-            "podman",
-            "run",
-            "-it",
-            "--rm",
-            "--entrypoint=",
-            compose["services"]["nexus"]["image"],
-            "id",
-            "-g",
-        ]
-    ).stdout.strip()
+    nexus_ids = common.run_many(
+        {
+            name: [
+                "podman",
+                "run",
+                "-it",
+                "--rm",
+                "--entrypoint=",
+                compose["services"]["nexus"]["image"],
+                "id",
+                flag,
+            ]
+            for name, flag in (("uid", "-u"), ("gid", "-g"))
+        },
+        check=True,
+    )
+    nexus_uid = nexus_ids["uid"].stdout.strip()
+    nexus_gid = nexus_ids["gid"].stdout.strip()
     logger.info("Setting up docker-compose.yml")
     volume_path = os.path.join(
         cachito_repo_path, compose["services"]["nexus"]["volumes"][0].split(":")[0]
@@ -93,12 +87,12 @@ def start(cachito_repo_path: str):
     )
 
     # Start the services
-    common.run(["podman-compose", "up", "-d"], cwd=cachito_repo_path)
-    logger.info("Waiting for services to be operational. Sleeping for 30 seconds")
-    time.sleep(30)
-
-    # Get services data
-    services = common.get_services(cachito_repo_path)
+    common.invalidate_discovery_cache(cachito_repo_path)
+    common.run(["podman-compose", "up", "-d"], cwd=cachito_repo_path, print_output=True)
+    logger.info("Waiting for services to be operational")
+    services = common.wait_for_services(
+        cachito_repo_path, timeout=_START_TIMEOUT, require_all=True
+    )
     logger.info("Services are operational")
     return services
 
@@ -111,8 +105,11 @@ def stop(cachito_repo_path: str):
         exit(1)
 
     logger.info("Stopping Cachito server")
+    common.invalidate_discovery_cache(cachito_repo_path)
     common.run(
-        ["podman-compose", "down", "-v", "--remove-orphans"], cwd=cachito_repo_path
+        ["podman-compose", "down", "-v", "--remove-orphans"],
+        cwd=cachito_repo_path,
+        print_output=True,
     )
     logger.info("Removing volumes")
     compose = _get_compose_file_data(cachito_repo_path)
@@ -121,6 +118,11 @@ def stop(cachito_repo_path: str):
     )
     common.run(["podman", "unshare", "rm", "-rf", volume_path])
 
+    # The Nexus repositories are gone with the volumes
+    import nexus_index
+
+    nexus_index.get_index().forget_all()
+
 
 def restart(cachito_repo_path: str):
     """Restart the Cachito server if is running or start it if is not running"""
@@ -201,21 +203,20 @@ def click_add_group(cli: click.Group) -> None:
     cli.add_command(cmd_server)
 
 
-@pytest.mark.usefixtures("server")
 class TestServer:
-    def test_status(self, runner):
+    def test_status(self, runner, server):
         # change cwd to something else
         os.chdir("/tmp")
         result = runner.invoke(cmd_status, [])
         assert result.exit_code == 0
         assert "All services are operational" in result.output
 
-    def test_status_when_not_running(self, runner):
+    def test_status_when_not_running(self, runner, server):
         result = runner.invoke(cmd_status, [])
         assert result.exit_code == 1
         assert "All services are operational" not in result.output
 
-    def test_start_twice(self, runner):
+    def test_start_twice(self, runner, server):
         result = runner.invoke(cmd_start, [])
         assert result.exit_code == 0
         assert "Cachito server is already running" in result.output
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from click.testing import CliRunner
 
@@ -12,6 +14,56 @@ def pytest_addoption(parser):
         action="store_true",
         default=False,
     )
+    parser.addoption(
+        "--benchmark",
+        help="Run the benchmarks, see benchmark_nexus.py",
+        action="store_true",
+        default=False,
+    )
+    parser.addoption(
+        "--benchmark-json",
+        help="Write the benchmark results to this JSON file",
+        default=None,
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: only runs with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, needs --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+_benchmark_results = []
+
+
+@pytest.fixture
+def benchmark_report():
+    """Returns a function to report a benchmark result (dict)"""
+    return _benchmark_results.append
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not _benchmark_results:
+        return
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(
+        f"{'name':<50} {'components':>10} {'seconds':>9} {'requests':>9} {'peak MiB':>9}"
+    )
+    for result in _benchmark_results:
+        terminalreporter.write_line(
+            f"{result['name']:<50} {result['components']:>10} {result['seconds']:>9.3f}"
+            f" {result['requests']:>9} {result['peak_memory'] / 2**20:>9.1f}"
+        )
+    if config.getoption("--benchmark-json"):
+        with open(config.getoption("--benchmark-json"), "w") as f:
+            json.dump(_benchmark_results, f, indent=4)
 
 
 @pytest.fixture(scope="session", autouse=True)
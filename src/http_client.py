@@ -0,0 +1,141 @@
+"""
+HTTP client
+
+Pooled sessions used for the REST calls, one per service, so the many small
+requests to Nexus and Cachito reuse their connections. Each session has a
+default timeout and retries the idempotent requests on connection errors and
+on the transient error status codes, with a jittered exponential backoff.
+
+'requests' takes a while to import, so this module is only imported by the
+functions that need it, and not when the CLI starts.
+"""
+
+import threading
+import urllib.parse
+
+import requests
+from urllib3.util.retry import Retry
+
+import tracing
+
+# The Cachito services use self-signed certificates
+requests.packages.urllib3.disable_warnings()
+
+# Session settings of each service:
+# - pool_size: connections kept alive, per host
+# - timeout: default (connect, read) timeouts, in seconds
+# - retries: attempts after the first one. 0 disables the retries
+_SERVICES = {
+    # The Python resolver runs 8 jobs, plus the page prefetch of the listings
+    "nexus": {"pool_size": 16, "timeout": (5, 60), "retries": 3},
+    "cachito": {"pool_size": 8, "timeout": (5, 60), "retries": 3},
+    # The health checks have their own retry loop, see wait_for_services()
+    "probe": {"pool_size": 4, "timeout": (2, 5), "retries": 0},
+}
+
+# Status codes retried, when the method is idempotent
+_RETRY_STATUS = (429, 502, 503, 504)
+_RETRY_BACKOFF = 0.5
+_RETRY_BACKOFF_JITTER = 0.5
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class TracedSession(requests.Session):
+    """Session recording each request as a tracing span
+
+    Requests without a 'timeout' use the session one.
+    """
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with tracing.span(
+            f"{method} {urllib.parse.urlparse(url).path}", "http", url=url
+        ) as attributes:
+            r = super().request(method, url, *args, **kwargs)
+            attributes["status_code"] = r.status_code
+            return r
+
+
+def _new_session(service: str) -> TracedSession:
+    settings = _SERVICES[service]
+    session = TracedSession(timeout=settings["timeout"])
+    session.verify = False
+    retry = Retry(
+        total=settings["retries"],
+        backoff_factor=_RETRY_BACKOFF,
+        backoff_jitter=_RETRY_BACKOFF_JITTER,
+        status_forcelist=_RETRY_STATUS,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        # Return the last response, the callers check the status code
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=settings["pool_size"], max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(service: str) -> TracedSession:
+    """Get the shared session of a service
+
+    Args:
+        service (str): Service name. Example: nexus, cachito, probe
+
+    Returns:
+        TracedSession: Session shared by all the calls to the service
+    """
+    with _sessions_lock:
+        if service not in _sessions:
+            _sessions[service] = _new_session(service)
+        return _sessions[service]
+
+
+class TestHttpClient:
+    def test_retries(self, monkeypatch):
+        import http.server
+
+        monkeypatch.setattr("http_client._RETRY_BACKOFF", 0)
+        monkeypatch.setattr("http_client._RETRY_BACKOFF_JITTER", 0)
+        calls = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self):
+                calls.append((self.command, self.client_address[1]))
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status = 503 if len(calls) < 3 else 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_GET = do_POST = _reply
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        try:
+            session = _new_session("nexus")
+            # Retried until it succeeds, on the same connection
+            assert session.get(url).status_code == 200
+            assert len(calls) == 3
+            assert len({port for _, port in calls}) == 1
+
+            # POST is not idempotent, the error is returned
+            calls.clear()
+            assert session.post(url, json={}).status_code == 503
+            assert len(calls) == 1
+        finally:
+            server.shutdown()
+            server.server_close()
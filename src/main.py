@@ -1,22 +1,105 @@
+import importlib
+import os
+import subprocess
+import sys
+
 import click
 
-import cli_builder
-import cli_nexus
-import cli_pip
-import cli_server
+# Command groups, by name: (module, help)
+# The modules are only imported when one of their commands is used, so
+# 'constructor --help' doesn't pay for requests, jinja2, yaml, etc.
+_GROUPS = {
+    "server": ("cli_server", "Proxy and tool servers"),
+    "builder": ("cli_builder", "Container builder commands"),
+    "nexus": ("cli_nexus", "Sonatype Nexus commands"),
+    "pip": ("cli_pip", "Pip server commands"),
+    "cachito": ("cli_cachito", "Cachito requests commands"),
+    "daemon": ("cli_daemon", "Daemon keeping the caches warm between commands"),
+}
+
+
+class LazyGroup(click.Group):
+    """Group loading the command groups from their modules on demand"""
+
+    def list_commands(self, ctx) -> list:
+        return sorted({*super().list_commands(ctx), *_GROUPS})
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in _GROUPS and cmd_name not in self.commands:
+            module_name, _ = _GROUPS[cmd_name]
+            module = importlib.import_module(module_name)
+            module.click_add_group(self)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        # Use the static help, to not import the modules
+        rows = [(name, help) for name, (_, help) in sorted(_GROUPS.items())]
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
+def cli():
+    import datetime
+
+    import common
+
+    logger = common.get_logger()
+    logger.debug("- Starting Cachito CLI -")
+    logger.debug(f"{datetime.datetime.now().strftime('%Y-%m-%d')}")
+
 
 # main
 # --------------------
 if __name__ == "__main__":
+    import cli_daemon
+
+    # Run it in the daemon, if there is one
+    exit_code = cli_daemon.forward(sys.argv[1:])
+    if exit_code is None:
+        cli(prog_name="constructor")
+    sys.exit(exit_code)
+
+
+class TestMain:
+    # Modules that must not be imported to show the help
+    _HEAVY_MODULES = ("requests", "jinja2", "yaml", "schema", "pytest", "common")
+    # Budget of the imports and the help, in seconds. It usually takes a
+    # third of it; the median of several runs absorbs the one-off slow ones
+    _HELP_BUDGET = 0.1
+    _HELP_RUNS = 5
 
-    @click.group()
-    def cli():
-        pass
+    def test_help_import_budget(self):
+        import statistics
 
-    cli_server.click_add_group(cli)
-    cli_builder.click_add_group(cli)
-    cli_nexus.click_add_group(cli)
-    cli_pip.click_add_group(cli)
-    # TODO migrate "cachito" group
+        script = (
+            "import sys, time\n"
+            "started_at = time.perf_counter()\n"
+            "import main\n"
+            "main.cli.main(['--help'], standalone_mode=False)\n"
+            "print(time.perf_counter() - started_at, file=sys.stderr)\n"
+            "print(' '.join(m for m in sys.modules if m.split('.')[0] in sys.argv[1:]), file=sys.stderr)\n"
+        )
+        elapsed = []
+        for _ in range(self._HELP_RUNS):
+            result = subprocess.run(
+                [sys.executable, "-c", script, *self._HEAVY_MODULES],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            run_elapsed, heavy_modules = result.stderr.split("\n")[:2]
+            assert heavy_modules == ""
+            elapsed.append(float(run_elapsed))
+        assert statistics.median(elapsed) < self._HELP_BUDGET, elapsed
+        for name, (_, help) in _GROUPS.items():
+            assert name in result.stdout
+            assert help in result.stdout
 
-    cli()
+    def test_groups_help(self, runner):
+        for name, (module_name, help) in _GROUPS.items():
+            group = cli.get_command(click.Context(cli), name)
+            assert group.help == help, module_name
+            result = runner.invoke(cli, [name, "--help"])
+            assert result.exit_code == 0
@@ -0,0 +1,412 @@
+"""
+Nexus index
+
+Local SQLite copy of the Nexus repositories components and assets.
+
+The components API has no "changed since" filter, but the components are
+listed in creation order and the 'continuationToken' points to the last
+component of a page. So an incremental sync resumes from the last page of
+the previous sync and only pulls the components created after it. A full
+sync walks the whole repository and also drops the deleted components and
+refreshes the assets data (download times, sizes, etc). It is also run when
+the resumed page is not in the index, as the repository was recreated.
+"""
+
+import datetime
+import functools
+import itertools
+import os
+import sqlite3
+import time
+
+import common
+
+logger = common.get_logger()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS repositories (
+    name TEXT PRIMARY KEY,
+    resume_token TEXT,
+    generation INTEGER NOT NULL DEFAULT 0,
+    synced_at REAL,
+    full_synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS components (
+    id TEXT PRIMARY KEY,
+    repository TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT,
+    format TEXT,
+    "group" TEXT,
+    generation INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS components_repository_name
+    ON components (repository, name);
+CREATE TABLE IF NOT EXISTS assets (
+    id TEXT PRIMARY KEY,
+    component_id TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    path TEXT,
+    download_url TEXT,
+    content_type TEXT,
+    file_size INTEGER,
+    last_downloaded REAL,
+    last_modified REAL,
+    blob_created REAL
+);
+CREATE INDEX IF NOT EXISTS assets_component_id
+    ON assets (component_id);
+CREATE INDEX IF NOT EXISTS assets_repository_last_downloaded
+    ON assets (repository, last_downloaded);
+"""
+
+
+def get_index_path() -> str:
+    """Returns the path of the index database"""
+    return os.path.join(common.get_cache_dir(), "nexus-index.sqlite3")
+
+
+def _to_timestamp(value):
+    """Convert a Nexus ISO 8601 date to a POSIX timestamp"""
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class NexusIndex:
+    def __init__(self, path: str = None):
+        self.path = path or get_index_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _get_repository(self, repo_name: str) -> sqlite3.Row:
+        return self.db.execute(
+            "SELECT * FROM repositories WHERE name = ?", (repo_name,)
+        ).fetchone()
+
+    def _store_page(self, repo_name: str, generation: int, items: list) -> None:
+        self.db.executemany(
+            'INSERT OR REPLACE INTO components (id, repository, name, version, format, "group", generation)'
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    item["id"],
+                    repo_name,
+                    item["name"],
+                    item["version"],
+                    item["format"],
+                    item.get("group"),
+                    generation,
+                )
+                for item in items
+            ],
+        )
+        self.db.executemany(
+            "DELETE FROM assets WHERE component_id = ?",
+            [(item["id"],) for item in items],
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO assets (id, component_id, repository, path, download_url, content_type,"
+            " file_size, last_downloaded, last_modified, blob_created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    asset["id"],
+                    item["id"],
+                    repo_name,
+                    asset.get("path"),
+                    asset.get("downloadUrl"),
+                    asset.get("contentType"),
+                    asset.get("fileSize"),
+                    _to_timestamp(asset.get("lastDownloaded")),
+                    _to_timestamp(asset.get("lastModified")),
+                    _to_timestamp(asset.get("blobCreated")),
+                )
+                for item in items
+                for asset in item.get("assets", [])
+            ],
+        )
+
+    def _is_indexed(self, repo_name: str, items: list) -> bool:
+        """Check if the first component of a page is in the index"""
+        if not items:
+            return False
+        return (
+            self.db.execute(
+                "SELECT 1 FROM components WHERE repository = ? AND id = ?",
+                (repo_name, items[0]["id"]),
+            ).fetchone()
+            is not None
+        )
+
+    def sync(self, services: dict, repo_name: str, full: bool = False) -> int:
+        """Sync the index with a Nexus repository
+
+        Args:
+            services (dict): Services data, from common.get_services()
+            repo_name (str): Nexus repository name
+            full (bool): Walk the whole repository instead of resuming from
+                         the last sync. Always the case for the first sync
+
+        Returns:
+            int: Number of components pulled from Nexus
+        """
+        repo = self._get_repository(repo_name)
+        generation = (repo["generation"] if repo else 0) + 1
+        full = full or repo is None or repo["full_synced_at"] is None
+
+        pages = None
+        if not full:
+            # Resume from the last page of the previous sync. The token may
+            # not be valid anymore (e.g. its component was deleted)
+            resume_token = repo["resume_token"]
+            r = common._nexus_get_components_page(services, repo_name, resume_token)
+            page = r.json() if r.status_code == 200 else None
+            if page is not None and not self._is_indexed(repo_name, page["items"]):
+                # The components of the resumed page are unknown, the
+                # repository was recreated (e.g. the Nexus volumes were wiped)
+                logger.warning(
+                    f"The '{repo_name}' repository was recreated. Running a full sync"
+                )
+                full = True
+            elif page is not None:
+                pages = [(resume_token, page["items"])]
+                if page["continuationToken"]:
+                    pages = itertools.chain(
+                        pages,
+                        common._nexus_iter_component_pages(
+                            services, repo_name, page["continuationToken"]
+                        ),
+                    )
+            else:
+                logger.warning(
+                    f"Can't resume the '{repo_name}' sync ({r.status_code}). Running a full sync"
+                )
+                full = True
+        if full:
+            resume_token = None
+            pages = common._nexus_iter_component_pages(services, repo_name)
+
+        logger.info(f"Syncing Nexus index: {repo_name} (full: {full})")
+        total = 0
+        with self.db:
+            for page_token, items in pages:
+                if items:
+                    resume_token = page_token
+                self._store_page(repo_name, generation, items)
+                total += len(items)
+
+            now = time.time()
+            if full:
+                # Drop everything that was not seen in this walk
+                self.db.execute(
+                    "DELETE FROM assets WHERE component_id IN"
+                    " (SELECT id FROM components WHERE repository = ? AND generation < ?)",
+                    (repo_name, generation),
+                )
+                self.db.execute(
+                    "DELETE FROM components WHERE repository = ? AND generation < ?",
+                    (repo_name, generation),
+                )
+            self.db.execute(
+                "INSERT INTO repositories (name, resume_token, generation, synced_at, full_synced_at)"
+                " VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET resume_token = excluded.resume_token,"
+                " generation = excluded.generation, synced_at = excluded.synced_at,"
+                " full_synced_at = COALESCE(excluded.full_synced_at, full_synced_at)",
+                (repo_name, resume_token, generation, now, now if full else None),
+            )
+        logger.info(f"Synced {total} components from '{repo_name}'")
+        return total
+
+    def forget(self, repo_name: str) -> None:
+        """Drop a repository from the index"""
+        with self.db:
+            self.db.execute("DELETE FROM assets WHERE repository = ?", (repo_name,))
+            self.db.execute("DELETE FROM components WHERE repository = ?", (repo_name,))
+            self.db.execute("DELETE FROM repositories WHERE name = ?", (repo_name,))
+
+    def forget_all(self) -> None:
+        """Drop all the repositories from the index"""
+        with self.db:
+            self.db.execute("DELETE FROM assets")
+            self.db.execute("DELETE FROM components")
+            self.db.execute("DELETE FROM repositories")
+
+    def query(
+        self,
+        repo_name: str,
+        name_prefix: str = None,
+        format: str = None,
+        downloaded_since: float = None,
+    ):
+        """Query the indexed components of a repository
+
+        Args:
+            repo_name (str): Nexus repository name
+            name_prefix (str): Only components whose name starts with it
+            format (str): Only components of this format. Example: pypi
+            downloaded_since (float): Only components with an asset downloaded
+                                      after this POSIX timestamp
+
+        Yields:
+            dict: Component data (id, name, version, format, group, last_downloaded)
+        """
+        sql = (
+            'SELECT c.id, c.name, c.version, c.format, c."group",'
+            " MAX(a.last_downloaded) AS last_downloaded"
+            " FROM components c LEFT JOIN assets a ON a.component_id = c.id"
+            " WHERE c.repository = ?"
+        )
+        params = [repo_name]
+        if name_prefix:
+            sql += " AND c.name LIKE ? ESCAPE '\\'"
+            escaped = name_prefix.replace("\\", "\\\\").replace("%", "\\%")
+            params.append(escaped.replace("_", "\\_") + "%")
+        if format:
+            sql += " AND c.format = ?"
+            params.append(format)
+        sql += " GROUP BY c.id"
+        if downloaded_since is not None:
+            sql += " HAVING MAX(a.last_downloaded) >= ?"
+            params.append(downloaded_since)
+        sql += " ORDER BY c.name, c.version"
+        for row in self.db.execute(sql, params):
+            yield dict(row)
+
+    def iter_components(self, services: dict, repo_name: str, full: bool = True):
+        """Sync the repository and iterate over its components
+
+        Drop-in replacement for common._nexus_iter_components()
+
+        Args:
+            services (dict): Services data, from common.get_services()
+            repo_name (str): Nexus repository name
+            full (bool): Full sync. An incremental one doesn't see the
+                         deleted components, nor the updated assets
+        """
+        self.sync(services, repo_name, full=full)
+        return self.query(repo_name)
+
+
+def get_index() -> NexusIndex:
+    """Returns the shared index for the current cache dir"""
+    return _get_index(get_index_path())
+
+
+@functools.cache
+def _get_index(path: str) -> NexusIndex:
+    return NexusIndex(path)
+
+
+class TestNexusIndex:
+    class _FakeNexus:
+        """Serves '/service/rest/v1/components' pages of 2 items"""
+
+        def __init__(self, count):
+            self.components = [self.component(i) for i in range(count)]
+            self.requests = 0
+
+        @staticmethod
+        def component(i, last_downloaded=None):
+            return {
+                "id": f"id-{i:04}",
+                "name": f"pkg-{i}",
+                "version": "1.0",
+                "format": "pypi",
+                "assets": [{"id": f"asset-{i:04}", "lastDownloaded": last_downloaded}],
+            }
+
+        def get_page(self, services, repo_name, cont_token=None):
+            self.requests += 1
+            start = int(cont_token or 0)
+            end = start + 2
+            page = {
+                "items": self.components[start:end],
+                "continuationToken": str(end) if end < len(self.components) else None,
+            }
+            return type("Response", (), {"status_code": 200, "json": lambda _: page})()
+
+    def _setup(self, monkeypatch, tmp_path, count):
+        nexus = self._FakeNexus(count)
+        monkeypatch.setattr(common, "_nexus_get_components_page", nexus.get_page)
+        return nexus, NexusIndex(str(tmp_path / "index.sqlite3"))
+
+    def test_incremental_sync(self, monkeypatch, tmp_path):
+        nexus, index = self._setup(monkeypatch, tmp_path, 5)
+        assert index.sync({}, "repo") == 5
+        assert nexus.requests == 3
+
+        nexus.components.append(nexus.component(5))
+        nexus.requests = 0
+        # Only the last known page and the new ones are pulled
+        assert index.sync({}, "repo") == 2
+        assert nexus.requests == 1
+        assert len(list(index.query("repo"))) == 6
+
+    def test_full_sync_drops_deleted(self, monkeypatch, tmp_path):
+        nexus, index = self._setup(monkeypatch, tmp_path, 4)
+        index.sync({}, "repo")
+        del nexus.components[0]
+        index.sync({}, "repo", full=True)
+        assert [c["name"] for c in index.query("repo")] == ["pkg-1", "pkg-2", "pkg-3"]
+
+    def test_iter_components_drops_deleted(self, monkeypatch, tmp_path):
+        nexus, index = self._setup(monkeypatch, tmp_path, 4)
+        index.sync({}, "repo")
+        del nexus.components[0]
+        # The requirements are generated from a full sync
+        names = [c["name"] for c in index.iter_components({}, "repo")]
+        assert names == ["pkg-1", "pkg-2", "pkg-3"]
+
+    def test_recreated_repository(self, monkeypatch, tmp_path):
+        nexus, index = self._setup(monkeypatch, tmp_path, 5)
+        index.sync({}, "repo")
+        # Same page layout, but new components
+        nexus.components = [
+            dict(nexus.component(i), id=f"new-{i:04}") for i in range(3)
+        ]
+        nexus.requests = 0
+        # The resumed page is unknown, the whole repository is pulled again
+        assert index.sync({}, "repo") == 3
+        assert nexus.requests == 3
+        assert [c["id"] for c in index.query("repo")] == [
+            "new-0000",
+            "new-0001",
+            "new-0002",
+        ]
+
+        index.forget_all()
+        assert list(index.query("repo")) == []
+
+    def test_query_filters(self, monkeypatch, tmp_path):
+        nexus, index = self._setup(monkeypatch, tmp_path, 0)
+        nexus.components = [
+            nexus.component(1, "2023-11-20T10:00:00.000+00:00"),
+            nexus.component(2, "2023-11-22T10:00:00.000+00:00"),
+            nexus.component(10),
+        ]
+        index.sync({}, "repo")
+        assert [c["name"] for c in index.query("repo", name_prefix="pkg-1")] == [
+            "pkg-1",
+            "pkg-10",
+        ]
+        since = _to_timestamp("2023-11-21T00:00:00+00:00")
+        assert [c["name"] for c in index.query("repo", downloaded_since=since)] == [
+            "pkg-2"
+        ]
+        assert list(index.query("repo", format="npm")) == []
+
+    def test_get_index_by_cache_dir(self, monkeypatch, tmp_path):
+        # e.g. daemon clients running from different directories
+        monkeypatch.setattr(common, "get_cache_dir", lambda: str(tmp_path / "a"))
+        index_a = get_index()
+        assert get_index() is index_a
+        monkeypatch.setattr(common, "get_cache_dir", lambda: str(tmp_path / "b"))
+        assert get_index() is not index_a
+        assert get_index().path == str(tmp_path / "b" / "nexus-index.sqlite3")
@@ -0,0 +1,779 @@
+"""
+Python resolver
+
+Resolves the Python dependencies against the Nexus pypi proxy, without
+installing or building anything.
+
+The releases are listed from the simple index (PEP 691 JSON when the server
+supports it, HTML otherwise). The dependencies of a release are read from
+the metadata of one of its wheels: the PEP 658 '.metadata' file when the
+index advertises it, or the '.dist-info/METADATA' member read with HTTP range
+requests. Releases without wheels fall back to the sdist PKG-INFO, when its
+'Requires-Dist' is reliable (metadata 2.2+). The metadata is memoized in the
+cache dir, since the files of a package index never change.
+
+Only releases with an sdist are candidates, because the container builds
+install everything from sources (PIP_NO_BINARY=:all:). The resolution is
+greedy: the newest candidate matching all the constraints is picked, and a
+package is re-picked when its constraints change. Conflicts that would need
+backtracking are reported; use the 'poetry' resolver for those.
+"""
+
+import collections
+import concurrent.futures
+import email.parser
+import hashlib
+import html.parser
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+import urllib.parse
+import zipfile
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.specifiers import InvalidSpecifier, SpecifierSet
+from packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion
+
+import common
+
+logger = common.get_logger()
+
+# Part of the resolutions cache key. Bump it when the resolution changes
+RESOLVER_VERSION = "native-1"
+
+# Number of concurrent requests to the index
+_RESOLVER_JOBS = 8
+
+# (connect, read) timeouts, in seconds, of each index request
+_INDEX_TIMEOUT = (5, 60)
+
+# Size of each HTTP range request when reading a wheel
+_RANGE_CHUNK = 64 * 1024
+
+# Maximum number of packages (re-)picked before giving up
+_MAX_ROUNDS = 10000
+
+_SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+
+# Environment markers of the containers, the packages are installed in
+# Linux x86_64 CPython images. The Python versions are set by the resolver
+_TARGET_ENVIRONMENT = {
+    "implementation_name": "cpython",
+    "os_name": "posix",
+    "platform_machine": "x86_64",
+    "platform_python_implementation": "CPython",
+    "platform_release": "",
+    "platform_system": "Linux",
+    "platform_version": "",
+    "sys_platform": "linux",
+}
+
+
+class ResolutionError(Exception):
+    pass
+
+
+def get_metadata_cache_dir() -> str:
+    """Returns the path of the memoized packages metadata"""
+    return os.path.join(common.get_cache_dir(), "python-metadata")
+
+
+def parse_python_version(python_version: str) -> str:
+    """Returns the lowest Python version allowed by a constraint
+
+    Args:
+        python_version (str): Python version constraint. Example: ^3.9
+
+    Returns:
+        str: "<major>.<minor>". Example: 3.9
+    """
+    match = re.search(r"(\d+)(?:\.(\d+))?", python_version)
+    if not match:
+        raise ResolutionError(f"Invalid pythonVersion: {python_version}")
+    return f"{match.group(1)}.{match.group(2) or 0}"
+
+
+class _SimpleIndexParser(html.parser.HTMLParser):
+    """Parse the files of a PEP 503 HTML project page"""
+
+    def __init__(self, page_url: str):
+        super().__init__()
+        self.page_url = page_url
+        self.files = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag != "a" or not attrs.get("href"):
+            return
+        url, _ = urllib.parse.urldefrag(
+            urllib.parse.urljoin(self.page_url, attrs["href"])
+        )
+        core_metadata = attrs.get("data-core-metadata") or attrs.get(
+            "data-dist-info-metadata"
+        )
+        self.files.append(
+            {
+                "filename": urllib.parse.unquote(
+                    os.path.basename(urllib.parse.urlparse(url).path)
+                ),
+                "url": url,
+                "requires-python": attrs.get("data-requires-python"),
+                "core-metadata": bool(core_metadata) and core_metadata != "false",
+                "yanked": "data-yanked" in attrs,
+            }
+        )
+
+
+class _HttpRangeFile(io.RawIOBase):
+    """Read-only seekable file backed by HTTP range requests
+
+    The tail of the file is read on open, so a zip central directory is
+    usually available without any other request.
+    """
+
+    def __init__(self, session, url: str):
+        super().__init__()
+        self.session = session
+        self.url = url
+        self.pos = 0
+        self._chunks = {}
+        r = session.get(
+            url, headers={"Range": f"bytes=-{_RANGE_CHUNK}"}, timeout=_INDEX_TIMEOUT
+        )
+        r.raise_for_status()
+        if r.status_code == 206:
+            self.size = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+            self._chunks[self.size - len(r.content)] = r.content
+        else:
+            # No range support, the whole file was sent
+            self.size = len(r.content)
+            self._chunks[0] = r.content
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        end = min(self.pos + len(b), self.size)
+        if end <= self.pos:
+            return 0
+        data = self._read_range(self.pos, end)
+        b[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def _read_range(self, start: int, end: int) -> bytes:
+        for chunk_start, chunk in self._chunks.items():
+            if chunk_start <= start and end <= chunk_start + len(chunk):
+                return chunk[start - chunk_start : end - chunk_start]
+        fetch_end = min(self.size, max(end, start + _RANGE_CHUNK))
+        r = self.session.get(
+            self.url,
+            headers={"Range": f"bytes={start}-{fetch_end - 1}"},
+            timeout=_INDEX_TIMEOUT,
+        )
+        if r.status_code != 206:
+            raise ResolutionError(f"Range request not supported: {self.url}")
+        self._chunks[start] = r.content
+        return r.content[: end - start]
+
+
+class Resolver:
+    def __init__(
+        self,
+        services: dict,
+        python_version: str,
+        repo_name: str = common._NEXUS_PIP_PROXY_REPO,
+        jobs: int = _RESOLVER_JOBS,
+    ):
+        """
+        Args:
+            services (dict): Services data, from common.get_services()
+            python_version (str): Python version constraint. Example: ^3.9
+            repo_name (str): Nexus pypi proxy repository
+            jobs (int): Maximum number of concurrent requests
+        """
+        self.index_url = (
+            f"{services['nexus']['url_local']}/repository/{repo_name}/simple"
+        )
+        self.jobs = jobs
+        self.session = common._nexus_session()
+        self.python_version = parse_python_version(python_version)
+        self.environment = {
+            **_TARGET_ENVIRONMENT,
+            "python_version": self.python_version,
+            "python_full_version": self.python_version + ".0",
+            "implementation_version": self.python_version + ".0",
+        }
+        self._projects = {}
+        self._metadata_memo = {}
+        self._lock = threading.Lock()
+
+    # Index
+    # ====================
+    def _get_project_files(self, name: str) -> list:
+        """Returns the files of a project, from its simple index page"""
+        page_url = f"{self.index_url}/{name}/"
+        r = self.session.get(
+            page_url,
+            headers={"Accept": f"{_SIMPLE_JSON}, text/html;q=0.1"},
+            timeout=_INDEX_TIMEOUT,
+        )
+        if r.status_code == 404:
+            raise ResolutionError(f"Package not found in the index: {name}")
+        if r.status_code != 200:
+            raise ResolutionError(
+                f"Error reading the index of '{name}': {r.status_code}"
+            )
+        if r.headers.get("Content-Type", "").startswith(_SIMPLE_JSON):
+            files = r.json()["files"]
+            for file in files:
+                file["url"] = urllib.parse.urldefrag(
+                    urllib.parse.urljoin(page_url, file["url"])
+                )[0]
+                file["core-metadata"] = bool(
+                    file.get("core-metadata", file.get("dist-info-metadata"))
+                )
+            return files
+        parser = _SimpleIndexParser(page_url)
+        parser.feed(r.text)
+        return parser.files
+
+    def _python_matches(self, requires_python: str) -> bool:
+        if not requires_python:
+            return True
+        try:
+            return SpecifierSet(requires_python).contains(
+                self.environment["python_full_version"], prereleases=True
+            )
+        except InvalidSpecifier:
+            return True
+
+    def _project(self, name: str) -> dict:
+        """Returns the releases of a project that can be installed from sources
+
+        Returns:
+            dict: {Version: {"sdist": file, "wheels": [file, ...]}}
+        """
+        if name in self._projects:
+            return self._projects[name]
+        releases = collections.defaultdict(lambda: {"sdist": None, "wheels": []})
+        for file in self._get_project_files(name):
+            if file.get("yanked") or not self._python_matches(
+                file.get("requires-python")
+            ):
+                continue
+            try:
+                if file["filename"].endswith(".whl"):
+                    version = parse_wheel_filename(file["filename"])[1]
+                    releases[version]["wheels"].append(file)
+                else:
+                    version = parse_sdist_filename(file["filename"])[1]
+                    releases[version]["sdist"] = file
+            except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+                continue
+        project = {
+            version: release
+            for version, release in releases.items()
+            if release["sdist"] is not None
+        }
+        with self._lock:
+            self._projects[name] = project
+        return project
+
+    # Metadata
+    # ====================
+    def _read_metadata(self, name: str, release: dict) -> str:
+        """Read the core metadata of a release"""
+        # Prefer the pure Python wheels, their metadata doesn't depend on the platform
+        wheels = sorted(
+            release["wheels"],
+            key=lambda file: not file["filename"].endswith("-any.whl"),
+        )
+        for wheel in wheels:
+            if wheel.get("core-metadata"):
+                r = self.session.get(wheel["url"] + ".metadata", timeout=_INDEX_TIMEOUT)
+                if r.status_code == 200:
+                    return r.text
+        for wheel in wheels:
+            with zipfile.ZipFile(_HttpRangeFile(self.session, wheel["url"])) as zf:
+                for member in zf.namelist():
+                    if re.fullmatch(r"[^/]+\.dist-info/METADATA", member):
+                        return zf.read(member).decode("utf-8")
+
+        # Only the sdist. Stream it until the PKG-INFO is found
+        sdist = release["sdist"]
+        if not sdist["filename"].endswith(".tar.gz"):
+            raise ResolutionError(f"Can't read the metadata of: {sdist['filename']}")
+        r = self.session.get(sdist["url"], stream=True, timeout=_INDEX_TIMEOUT)
+        r.raise_for_status()
+        with r, tarfile.open(fileobj=r.raw, mode="r|gz") as tar:
+            for member in tar:
+                if re.fullmatch(r"[^/]+/PKG-INFO", member.name):
+                    pkg_info = tar.extractfile(member).read().decode("utf-8")
+                    break
+            else:
+                raise ResolutionError(f"PKG-INFO not found: {sdist['filename']}")
+        message = email.parser.HeaderParser().parsestr(pkg_info)
+        metadata_version = tuple(
+            int(part) for part in message.get("Metadata-Version", "1.0").split(".")[:2]
+        )
+        dynamic = [field.lower() for field in message.get_all("Dynamic", [])]
+        if metadata_version < (2, 2) or "requires-dist" in dynamic:
+            raise ResolutionError(
+                f"No reliable dependencies metadata for '{sdist['filename']}'"
+                " (no wheels and a dynamic sdist)"
+            )
+        return pkg_info
+
+    def _metadata(self, name: str, version) -> dict:
+        """Returns the dependencies data of a release
+
+        Returns:
+            dict: {"requires_dist": [str, ...], "requires_python": str}
+        """
+        release = self._project(name)[version]
+        filename = release["sdist"]["filename"]
+        if filename in self._metadata_memo:
+            return self._metadata_memo[filename]
+
+        memo_path = os.path.join(
+            get_metadata_cache_dir(),
+            hashlib.sha256(filename.encode("utf-8")).hexdigest() + ".json",
+        )
+        try:
+            with open(memo_path, "r") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            message = email.parser.HeaderParser().parsestr(
+                self._read_metadata(name, release)
+            )
+            metadata = {
+                "requires_dist": message.get_all("Requires-Dist", []),
+                "requires_python": message.get("Requires-Python"),
+            }
+            os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+            with open(memo_path + f".{threading.get_ident()}", "w") as f:
+                json.dump(metadata, f)
+            os.replace(memo_path + f".{threading.get_ident()}", memo_path)
+
+        with self._lock:
+            self._metadata_memo[filename] = metadata
+        return metadata
+
+    def _dependencies(self, name: str, version, extras: frozenset) -> list:
+        """Returns the requirements of a release that apply to the target environment"""
+        requirements = []
+        for requirement_str in self._metadata(name, version)["requires_dist"]:
+            try:
+                requirement = Requirement(requirement_str)
+            except InvalidRequirement:
+                logger.warning(
+                    f"Ignoring invalid requirement of {name}: {requirement_str}"
+                )
+                continue
+            if requirement.marker and not any(
+                requirement.marker.evaluate({**self.environment, "extra": extra})
+                for extra in sorted(extras) or [""]
+            ):
+                continue
+            requirements.append(requirement)
+        return requirements
+
+    # Resolution
+    # ====================
+    def _pick(self, name: str, specifier: SpecifierSet, current=None):
+        """Returns the version to pin, keeping the current one if it still matches"""
+        candidates = list(specifier.filter(self._project(name)))
+        if current is not None and current in candidates:
+            return current
+        return next(
+            (
+                version
+                for version in sorted(candidates, reverse=True)
+                if self._python_matches(
+                    self._metadata(name, version)["requires_python"]
+                )
+            ),
+            None,
+        )
+
+    def resolve(self, requirements: list) -> dict:
+        """Resolve the requirements and all their dependencies
+
+        Args:
+            requirements (list): Requirements. Example: ["cryptography==41.0.5"]
+
+        Returns:
+            dict: {canonical name: Version}
+        """
+        root = ""
+        specifiers = collections.defaultdict(dict)  # name -> {parent: SpecifierSet}
+        extras = collections.defaultdict(dict)  # name -> {parent: set}
+        children = collections.defaultdict(set)  # parent -> {name}
+        pins = {}
+        applied = {}
+        queue = set()
+
+        def _require(parent: str, requirement: Requirement):
+            name = canonicalize_name(requirement.name)
+            specifiers[name][parent] = (
+                specifiers[name].get(parent, SpecifierSet()) & requirement.specifier
+            )
+            extras[name][parent] = extras[name].get(parent, set()) | requirement.extras
+            children[parent].add(name)
+            queue.add(name)
+
+        def _withdraw(parent: str):
+            for name in children.pop(parent, set()):
+                specifiers[name].pop(parent, None)
+                extras[name].pop(parent, None)
+                queue.add(name)
+
+        for requirement in requirements:
+            _require(root, Requirement(requirement))
+
+        rounds = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while queue:
+                batch = sorted(queue)
+                queue.clear()
+                rounds += len(batch)
+                if rounds > _MAX_ROUNDS:
+                    raise ResolutionError("The resolution is not converging")
+
+                required = {}
+                for name in batch:
+                    if not specifiers[name]:
+                        # Not required anymore
+                        pins.pop(name, None)
+                        applied.pop(name, None)
+                        _withdraw(name)
+                        continue
+                    specifier = SpecifierSet()
+                    for parent_specifier in specifiers[name].values():
+                        specifier &= parent_specifier
+                    required[name] = specifier
+
+                # Pick concurrently, each pick reads the index page and the
+                # metadata of the candidates it goes through
+                versions = executor.map(
+                    lambda name: self._pick(name, required[name], pins.get(name)),
+                    required,
+                )
+                picks = {}
+                for name, version in zip(required, versions):
+                    if version is None:
+                        raise ResolutionError(
+                            f"No version of '{name}' matches: "
+                            + ", ".join(
+                                f"{parent or '<root>'} requires '{spec or '*'}'"
+                                for parent, spec in sorted(specifiers[name].items())
+                            )
+                        )
+                    picks[name] = version
+
+                for name, version in picks.items():
+                    name_extras = frozenset().union(*extras[name].values())
+                    if applied.get(name) == (version, name_extras):
+                        continue
+                    if name in pins and pins[name] != version:
+                        logger.debug(f"Re-picking {name}: {pins[name]} -> {version}")
+                    _withdraw(name)
+                    pins[name] = version
+                    applied[name] = (version, name_extras)
+                    for requirement in self._dependencies(name, version, name_extras):
+                        _require(name, requirement)
+        return pins
+
+
+def resolve(services: dict, requirements: list, python_version: str) -> dict:
+    """Resolve the Python requirements against the Nexus pypi proxy
+
+    Args:
+        services (dict): Services data, from common.get_services()
+        requirements (list): Requirements. Example: ["cryptography==41.0.5"]
+        python_version (str): Python version constraint. Example: ^3.9
+
+    Returns:
+        dict: {canonical name: Version}
+    """
+    try:
+        return Resolver(services, python_version).resolve(requirements)
+    except ResolutionError as e:
+        logger.error("Error resolving the Python dependencies")
+        logger.error(f"└─ {e}")
+        exit(1)
+
+
+class TestResolver:
+    class _FakeResolver(Resolver):
+        def __init__(self, index: dict):
+            super().__init__({"nexus": {"url_local": "http://nexus"}}, "^3.9")
+            self.index = index
+
+        def _project(self, name):
+            from packaging.version import Version
+
+            return {Version(version): {} for version in self.index[name]}
+
+        def _metadata(self, name, version):
+            requires_dist, requires_python = self.index[name][str(version)]
+            return {"requires_dist": requires_dist, "requires_python": requires_python}
+
+    def test_resolve(self):
+        resolver = self._FakeResolver(
+            {
+                "app": {
+                    "1.0": (["lib>=1", "web[async]; python_version >= '3.8'"], None)
+                },
+                # 3.0 needs a newer Python
+                "lib": {"1.0": ([], None), "2.0": ([], None), "3.0": ([], ">=3.12")},
+                "web": {
+                    "1.0": (
+                        ["aio; extra == 'async'", "old; python_version < '3'"],
+                        None,
+                    )
+                },
+                "aio": {"1.0": ([], None)},
+                "old": {"1.0": ([], None)},
+            }
+        )
+        assert {
+            name: str(version) for name, version in resolver.resolve(["app"]).items()
+        } == {"app": "1.0", "lib": "2.0", "web": "1.0", "aio": "1.0"}
+
+    def test_target_environment(self, monkeypatch):
+        # The markers are evaluated for the containers, not for the host
+        monkeypatch.setattr("sys.platform", "darwin")
+        monkeypatch.setattr("platform.system", lambda: "Darwin")
+        resolver = self._FakeResolver(
+            {
+                "app": {
+                    "1.0": (
+                        [
+                            "linux; sys_platform == 'linux' and platform_machine == 'x86_64'",
+                            "windows; os_name == 'nt'",
+                            "pypy; implementation_name == 'pypy'",
+                        ],
+                        None,
+                    )
+                },
+                "linux": {"1.0": ([], None)},
+            }
+        )
+        assert {
+            name: str(version) for name, version in resolver.resolve(["app"]).items()
+        } == {"app": "1.0", "linux": "1.0"}
+
+    def test_repick_and_drop(self):
+        # b 2.0 requires c<2, dropping d required by c 2.0
+        resolver = self._FakeResolver(
+            {
+                "a": {"1.0": (["b", "c"], None)},
+                "b": {"2.0": (["c<2"], None)},
+                "c": {"1.0": ([], None), "2.0": (["d"], None)},
+                "d": {"1.0": ([], None)},
+            }
+        )
+        assert {
+            name: str(version) for name, version in resolver.resolve(["a"]).items()
+        } == {"a": "1.0", "b": "2.0", "c": "1.0"}
+
+    def test_simple_index_html(self):
+        parser = _SimpleIndexParser("http://nexus/repository/pip/simple/six/")
+        parser.feed(
+            '<a href="../../packages/six/1.16.0/six-1.16.0-py2.py3-none-any.whl#sha256=8a"'
+            ' data-requires-python="&gt;=2.7" data-dist-info-metadata="sha256=ab">'
+            "six-1.16.0-py2.py3-none-any.whl</a>"
+            '<a href="../../packages/six/1.16.0/six-1.16.0.tar.gz" data-yanked="">'
+            "six-1.16.0.tar.gz</a>"
+        )
+        assert parser.files == [
+            {
+                "filename": "six-1.16.0-py2.py3-none-any.whl",
+                "url": "http://nexus/repository/pip/packages/six/1.16.0/six-1.16.0-py2.py3-none-any.whl",
+                "requires-python": ">=2.7",
+                "core-metadata": True,
+                "yanked": False,
+            },
+            {
+                "filename": "six-1.16.0.tar.gz",
+                "url": "http://nexus/repository/pip/packages/six/1.16.0/six-1.16.0.tar.gz",
+                "requires-python": None,
+                "core-metadata": False,
+                "yanked": True,
+            },
+        ]
+
+    def test_read_metadata(self, monkeypatch, tmp_path):
+        import http.server
+
+        def _wheel(name: str, requires_dist: list) -> bytes:
+            f = io.BytesIO()
+            with zipfile.ZipFile(f, "w") as zf:
+                zf.writestr(
+                    f"{name}-1.0.dist-info/METADATA",
+                    f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n"
+                    + "".join(f"Requires-Dist: {r}\n" for r in requires_dist),
+                )
+                # Pushes the METADATA out of the tail read on open
+                zf.writestr(f"{name}/data.bin", bytes(range(256)) * 400)
+            return f.getvalue()
+
+        def _sdist(name: str, pkg_info: str) -> bytes:
+            f = io.BytesIO()
+            with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                data = pkg_info.encode()
+                member = tarfile.TarInfo(f"{name}-1.0/PKG-INFO")
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+            return f.getvalue()
+
+        simple = "/repository/pip/simple"
+        packages = "/repository/pip/packages"
+        files = {
+            # PEP 691 JSON page, with the PEP 658 metadata
+            f"{simple}/alpha/": (
+                _SIMPLE_JSON,
+                json.dumps(
+                    {
+                        "files": [
+                            {
+                                "filename": "alpha-1.0.tar.gz",
+                                "url": "../../packages/alpha-1.0.tar.gz",
+                            },
+                            {
+                                "filename": "alpha-1.0-py3-none-any.whl",
+                                "url": "../../packages/alpha-1.0-py3-none-any.whl",
+                                "core-metadata": {"sha256": "ab"},
+                            },
+                        ]
+                    }
+                ).encode(),
+            ),
+            f"{packages}/alpha-1.0-py3-none-any.whl.metadata": (
+                "text/plain",
+                b"Metadata-Version: 2.1\nName: alpha\nRequires-Dist: beta\n",
+            ),
+            # HTML page, the wheel METADATA is read with range requests
+            f"{simple}/beta/": (
+                "text/html",
+                b'<a href="../../packages/beta-1.0.tar.gz">beta-1.0.tar.gz</a>'
+                b'<a href="../../packages/beta-1.0-py3-none-any.whl">w</a>',
+            ),
+            f"{packages}/beta-1.0-py3-none-any.whl": (
+                "application/octet-stream",
+                _wheel("beta", ["gamma>=1"]),
+            ),
+            # Only an sdist, with a reliable PKG-INFO
+            f"{simple}/gamma/": (
+                "text/html",
+                b'<a href="../../packages/gamma-1.0.tar.gz">gamma-1.0.tar.gz</a>',
+            ),
+            f"{packages}/gamma-1.0.tar.gz": (
+                "application/octet-stream",
+                _sdist("gamma", "Metadata-Version: 2.2\nName: gamma\nVersion: 1.0\n"),
+            ),
+        }
+        requests_log = []
+        range_support = True
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                requests_log.append((self.path, self.headers.get("Range")))
+                if self.path not in files:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                content_type, body = files[self.path]
+                size = len(body)
+                range_header = self.headers.get("Range")
+                if range_header and range_support:
+                    start, end = range_header.removeprefix("bytes=").split("-")
+                    if start:
+                        start, end = int(start), min(int(end), size - 1)
+                    else:
+                        start, end = max(0, size - int(end)), size - 1
+                    body = body[start : end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        services = {"nexus": {"url_local": f"http://127.0.0.1:{server.server_port}"}}
+
+        def _resolve(memo_dir: str) -> dict:
+            monkeypatch.setattr(
+                "python_resolver.get_metadata_cache_dir", lambda: memo_dir
+            )
+            requests_log.clear()
+            resolver = Resolver(services, "^3.9", repo_name="pip")
+            pins = resolver.resolve(["alpha"])
+            return {name: str(version) for name, version in pins.items()}
+
+        expected = {"alpha": "1.0", "beta": "1.0", "gamma": "1.0"}
+        wheel = f"{packages}/beta-1.0-py3-none-any.whl"
+        try:
+            assert _resolve(str(tmp_path / "memo")) == expected
+            metadata_url = f"{packages}/alpha-1.0-py3-none-any.whl.metadata"
+            assert (metadata_url, None) in requests_log
+            # The tail, with the central directory, then the METADATA
+            assert [r for path, r in requests_log if path == wheel] == [
+                f"bytes=-{_RANGE_CHUNK}",
+                f"bytes=0-{_RANGE_CHUNK - 1}",
+            ]
+            assert (f"{packages}/gamma-1.0.tar.gz", None) in requests_log
+
+            # Without range support, the whole wheel is read at once
+            range_support = False
+            assert _resolve(str(tmp_path / "memo-no-range")) == expected
+            assert [r for path, r in requests_log if path == wheel] == [
+                f"bytes=-{_RANGE_CHUNK}"
+            ]
+
+            # Memoized, only the index pages are read
+            assert _resolve(str(tmp_path / "memo")) == expected
+            assert sorted(path for path, _ in requests_log) == [
+                f"{simple}/alpha/",
+                f"{simple}/beta/",
+                f"{simple}/gamma/",
+            ]
+        finally:
+            server.shutdown()
+            server.server_close()
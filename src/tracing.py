@@ -0,0 +1,180 @@
+"""
+Tracing
+
+Records nested timing spans and exports them in the Chrome trace event
+format, which can be opened in https://ui.perfetto.dev or chrome://tracing.
+
+Recording is disabled by default, and a span is then a no-op. Each thread
+is a track of the trace; a span can also open its own track, for work that
+runs at the same time in one thread (e.g. the commands of run_many()).
+"""
+
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+# Recorded events, None when tracing is disabled
+_events = None
+_lock = threading.Lock()
+_track_ids = itertools.count(1)
+_thread_tracks = {}
+
+# Current track of the context, None to use the thread's one
+_current_track = contextvars.ContextVar("current_track", default=None)
+
+
+def enable() -> None:
+    """Start recording the spans"""
+    global _events
+    with _lock:
+        _events = []
+
+
+def disable() -> None:
+    """Stop recording the spans, and drop the recorded ones"""
+    global _events
+    with _lock:
+        _events = None
+
+
+def is_enabled() -> bool:
+    return _events is not None
+
+
+def _new_track(name: str) -> int:
+    track = next(_track_ids)
+    _events.append(
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": track,
+            "args": {"name": name},
+        }
+    )
+    return track
+
+
+def _get_track() -> int:
+    track = _current_track.get()
+    if track is not None:
+        return track
+    thread = threading.current_thread()
+    with _lock:
+        if thread.ident not in _thread_tracks:
+            _thread_tracks[thread.ident] = _new_track(thread.name)
+        return _thread_tracks[thread.ident]
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = "constructor", new_track=False, **attributes):
+    """Record the duration of a block
+
+    Args:
+        name (str): Span name
+        category (str): Span category. Example: subprocess, http
+        new_track (bool): Record the span, and the spans inside it, in a
+                          track of its own
+        attributes: Attributes of the span, shown in the trace viewer
+
+    Yields:
+        dict: The span attributes. Values set on it are recorded when the
+              block ends
+    """
+    if _events is None:
+        yield attributes
+        return
+
+    token = None
+    if new_track:
+        with _lock:
+            token = _current_track.set(_new_track(name))
+    track = _get_track()
+    started_at = time.perf_counter_ns()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        ended_at = time.perf_counter_ns()
+        if token is not None:
+            _current_track.reset(token)
+        with _lock:
+            if _events is not None:
+                _events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": started_at / 1000,
+                        "dur": (ended_at - started_at) / 1000,
+                        "pid": os.getpid(),
+                        "tid": track,
+                        "args": attributes,
+                    }
+                )
+
+
+def traced(name: str = None, category: str = "constructor"):
+    """Decorator recording each call of a function as a span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__qualname__, category):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write(path: str) -> None:
+    """Write the recorded spans to a Chrome trace JSON file"""
+    with _lock:
+        events = list(_events or [])
+    events.append(
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {"name": "constructor"},
+        }
+    )
+    with open(path, "w") as f:
+        json.dump(
+            {"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1, default=str
+        )
+
+
+class TestTracing:
+    def test_spans(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("tracing._events", None)
+        with span("disabled") as attributes:
+            attributes["ignored"] = True
+
+        enable()
+        with span("outer", answer=42):
+            with span("inner") as attributes:
+                attributes["status_code"] = 200
+            with span("concurrent", new_track=True):
+                pass
+        path = tmp_path / "trace.json"
+        write(str(path))
+
+        with open(path) as f:
+            events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+        assert [e["name"] for e in events] == ["inner", "concurrent", "outer"]
+        inner, concurrent, outer = events
+        assert inner["args"] == {"status_code": 200}
+        assert outer["args"] == {"answer": 42}
+        assert inner["tid"] == outer["tid"] != concurrent["tid"]
+        assert outer["ts"] <= inner["ts"]
+        assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]